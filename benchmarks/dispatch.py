@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import random
+import timeit
+from virtualpad.pads.devices import update, encode, INPUT_EVENT, ZERO_STATE, MAX_FRAME_SIZE, EV_SYN, EV_KEY, EV_ABS, \
+    EV_MSC, SYN_REPORT, MSC_SCAN, BTN_UP, BTN_DOWN, BTN_LEFT, BTN_RIGHT, ABS_X, ABS_Y
+
+
+"""
+Compares the cost of turning received frames into input_event records:
+the previous per-event branching path (normalization into a list of tuples,
+then D-Pad resolution with sets) against the table-driven one.
+
+Run it from the repository root: python -m benchmarks.dispatch
+"""
+
+
+_AXES = ((EV_ABS, 0x00), (EV_ABS, 0x01), (EV_ABS, 0x03), (EV_ABS, 0x04))
+
+
+def _legacy(buffer: bytes) -> bytearray:
+    """
+    The previous path: the normalization done by the pad session
+    and the encoding done by the device, one branch per event.
+    """
+
+    fixed = []
+    for index in range(0, len(buffer), 2):
+        key, state = buffer[index:index + 2]
+        if 0 <= key < 14:
+            fixed.append((key, state and 1))
+        else:
+            fixed.append((key, min(255, max(0, state))))
+
+    pack = INPUT_EVENT.pack
+    encoded = bytearray()
+    abs_x_forced = False
+    abs_y_forced = False
+    abs_x_changes = None
+    abs_y_changes = None
+    for event, value in fixed:
+        if event < 10:
+            encoded += pack(0, 0, EV_MSC, MSC_SCAN, 0x90001 + event)
+            encoded += pack(0, 0, EV_KEY, 0x120 + event, 1 if value else 0)
+        elif event < 14:
+            if event == BTN_UP:
+                abs_y_changes = (abs_y_changes or set()) | {[127, 0][value]}
+            elif event == BTN_DOWN:
+                abs_y_changes = (abs_y_changes or set()) | {[127, 255][value]}
+            elif event == BTN_LEFT:
+                abs_x_changes = (abs_x_changes or set()) | {[127, 0][value]}
+            elif event == BTN_RIGHT:
+                abs_x_changes = (abs_x_changes or set()) | {[127, 255][value]}
+        else:
+            if event == ABS_X:
+                abs_x_forced = True
+            if event == ABS_Y:
+                abs_y_forced = True
+            encoded += pack(0, 0, *_AXES[event - 14], int(min(255, max(0, value))))
+    if not abs_x_forced and abs_x_changes is not None:
+        abs_x_changes -= {127}
+        encoded += pack(0, 0, *_AXES[0], abs_x_changes.pop() if len(abs_x_changes) == 1 else 127)
+    if not abs_y_forced and abs_y_changes is not None:
+        abs_y_changes -= {127}
+        encoded += pack(0, 0, *_AXES[1], abs_y_changes.pop() if len(abs_y_changes) == 1 else 127)
+    encoded += pack(0, 0, EV_SYN, SYN_REPORT, 0)
+    return encoded
+
+
+def _frames(count: int, keys: int):
+    """
+    Builds random frames, each one with some distinct keys.
+    """
+
+    generator = random.Random(2357)
+    frames = []
+    for _ in range(count):
+        frame = bytearray()
+        for key in generator.sample(range(18), keys):
+            frame += bytes([key, generator.choice((0, 1, 255) if key < 14 else range(256))])
+        frames.append(bytes(frame))
+    return frames
+
+
+def main():
+    number = 20
+    for keys in (1, 4, 17):
+        frames = _frames(5000, keys)
+        state = bytearray(ZERO_STATE)
+        buffer = bytearray(MAX_FRAME_SIZE)
+
+        def legacy():
+            for frame in frames:
+                _legacy(frame)
+
+        def table():
+            for frame in frames:
+                # Every key is encoded, as the legacy path does not
+                # suppress anything (state deltas are not measured here).
+                present, _ = update(state, frame)
+                encode(state, present, buffer)
+
+        for name, function in (("legacy", legacy), ("table", table)):
+            elapsed = min(timeit.repeat(function, number=number, repeat=5))
+            print(f"{keys:2d} keys/frame, {name:>6}: {elapsed * 1e9 / (number * len(frames)):8.0f} ns/frame")
+
+
+if __name__ == "__main__":
+    main()
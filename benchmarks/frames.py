@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os
+import random
+import threading
+import timeit
+from virtualpad.pads import PadSlot
+from virtualpad.pads.devices import update, diff_packed, apply_packed, PadDevice, PACKED_STATE, ZERO_STATE, \
+    MAX_FRAME_SIZE, N_BUTTONS, N_KEYS, BTN_UP, BTN_DOWN, BTN_LEFT, BTN_RIGHT, BTN_SOUTH, ABS_X, ABS_Y
+from virtualpad.frames import FULL_STATE
+
+
+"""
+Compares the protocol v1 frames (a length byte and (key, state) pairs)
+against the protocol v2 full state frames (an opcode byte and the packed
+state): how many bytes each one takes on the wire, and how long it takes
+to turn each one into an update of the known state. Before that, it
+checks that both give exactly the same records on the device.
+
+Run it from the repository root: python -m benchmarks.frames
+"""
+
+
+def _states(count: int, keys: int):
+    """
+    Builds a random sequence of states, each one with some keys
+    changed from the previous one.
+    """
+
+    generator = random.Random(2357)
+    state = bytearray(ZERO_STATE)
+    states = []
+    for _ in range(count):
+        for key in generator.sample(range(N_KEYS), keys):
+            if key < N_BUTTONS:
+                state[key] ^= 1
+            else:
+                state[key] = generator.randrange(256)
+        states.append(bytes(state))
+    return states
+
+
+# A v1 frame has at most N_KEYS - 1 pairs.
+_MAX_PAIRS = N_KEYS - 1
+
+
+def _v1(pairs: bytes) -> bytes:
+    """
+    Splits (key, state) pairs into as many v1 frames as needed.
+    """
+
+    data = bytearray()
+    for start in range(0, len(pairs), 2 * _MAX_PAIRS):
+        chunk = pairs[start:start + 2 * _MAX_PAIRS]
+        data += bytes([len(chunk) >> 1]) + chunk
+    return bytes(data or bytes([0]))
+
+
+def _v1_delta(previous: bytes, state: bytes) -> bytes:
+    return _v1(bytes(value for key in range(N_KEYS) if previous[key] != state[key] for value in (key, state[key])))
+
+
+def _v1_full(state: bytes) -> bytes:
+    # The whole state takes two frames.
+    return _v1(bytes(value for key in range(N_KEYS) for value in (key, state[key])))
+
+
+def _v2(state: bytes) -> bytes:
+    mask = sum(state[key] << key for key in range(N_BUTTONS))
+    return bytes([FULL_STATE]) + PACKED_STATE.pack(mask, *state[N_BUTTONS:])
+
+
+def _frames(data: bytes):
+    """
+    Splits v1 frames, as the frame buffer does.
+    """
+
+    start = 0
+    while start < len(data):
+        stop = start + 1 + (data[start] << 1)
+        yield data[start + 1:stop]
+        start = stop
+
+
+class _PipeSlot(PadSlot):
+    """
+    A slot whose device is a pipe, so the records written to it can
+    be read back (and no uinput device is needed).
+    """
+
+    def _make_device(self) -> bool:
+        self._output, write = os.pipe()
+        self._device = PadDevice(None, write, bytearray(MAX_FRAME_SIZE), threading.Lock())
+        self._reset_state()
+        return True
+
+    def written(self) -> bytes:
+        os.set_blocking(self._output, False)
+        try:
+            return os.read(self._output, 1 << 16)
+        except BlockingIOError:
+            return b""
+
+
+def _check():
+    """
+    Checks that sending the same sequence of states as v1 deltas and
+    as v2 full states writes the same records, with the D-Pad and the
+    stick interleaved.
+    """
+
+    generator = random.Random(2357)
+    keys = (BTN_UP, BTN_DOWN, BTN_LEFT, BTN_RIGHT, BTN_SOUTH, ABS_X, ABS_Y)
+    state = bytearray(ZERO_STATE)
+    # The stick off center, the D-Pad pressed and released, and the same stick again.
+    states = [bytes(state)]
+    for key, value in ((ABS_Y, 50), (BTN_UP, 1), (BTN_UP, 0), (ABS_Y, 50), (BTN_DOWN, 1), (ABS_Y, 200),
+                       (BTN_DOWN, 0)):
+        state[key] = value
+        states.append(bytes(state))
+    for _ in range(5000):
+        for key in generator.sample(keys, generator.randint(1, 3)):
+            state[key] = generator.randint(0, 1) if key < N_BUTTONS else generator.choice((0, 50, 127, 200, 255))
+        states.append(bytes(state))
+
+    v1, v2 = _PipeSlot(0), _PipeSlot(1)
+    v1.occupy("v1", 0)
+    v2.occupy("v2", 1)
+    v1.written()
+    v2.written()
+    for index in range(1, len(states)):
+        for frame in _frames(_v1_delta(states[index - 1], states[index])):
+            v1.emit(frame)
+        v2.emit_packed(_v2(states[index])[1:])
+        if v1.written() != v2.written():
+            raise AssertionError(f"v1 and v2 wrote different records at state #{index}")
+
+
+def main():
+    _check()
+    number = 20
+    for keys in (1, 4, 18):
+        states = _states(5000, keys)
+        previous = [ZERO_STATE] + states[:-1]
+        v1_delta = [_v1_delta(before, after) for before, after in zip(previous, states)]
+        v1_full = [_v1_full(state) for state in states]
+        v2 = [_v2(state) for state in states]
+
+        def parse_v1(frames):
+            def run():
+                state = bytearray(ZERO_STATE)
+                for data in frames:
+                    for frame in _frames(data):
+                        update(state, frame)
+            return run
+
+        def parse_v2():
+            state = bytearray(ZERO_STATE)
+            buttons = 0
+            for frame in v2:
+                packed = memoryview(frame)[1:]
+                changed, buttons = diff_packed(state, buttons, packed)
+                apply_packed(state, changed, buttons, packed)
+
+        for name, frames, function in (("v1 delta", v1_delta, parse_v1(v1_delta)),
+                                       ("v1 full", v1_full, parse_v1(v1_full)),
+                                       ("v2", v2, parse_v2)):
+            elapsed = min(timeit.repeat(function, number=number, repeat=5))
+            size = sum(len(frame) for frame in frames) / len(frames)
+            print(f"{keys:2d} keys changed/frame, {name:>8}: {elapsed * 1e9 / (number * len(frames)):8.0f} ns/frame, "
+                  f"{size:5.1f} bytes/frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Tuple, Optional
+from .base_server import launch_server_in_thread
+from .broadcast_server import BroadcastServer, PAD
+from .frames import FrameBuffer
+from .pad_server import PadSession, Liveness, PAD_PORT, AUTH_SIZE
+from .pads import PadSlots
+from .udp_channel import UdpChannel
+from . import tracing
+
+
+LOGGER = logging.getLogger("hawa.virtualpad.async-pad-server")
+LOGGER.setLevel(logging.INFO)
+# The states of a pad connection. Once ended (the login failed, or the
+# session was closed, kicked, or timed out), nothing else it sends is
+# processed, while the transport is being closed.
+_PENDING = "pending"
+_LOGGED_IN = "logged-in"
+_ENDED = "ended"
+
+
+class PadProtocol(asyncio.BufferedProtocol):
+    """
+    Attends a single pad connection in the event loop. All the work
+    that touches the slots (and, thus, the uinput devices) is done
+    in the server's single executor, one batch of received data at
+    a time: reading is paused while a batch is being processed, so
+    the loop never writes into the frame buffer while the executor
+    parses it.
+    """
+
+    def __init__(self, server: 'AsyncPadServer'):
+        self._server = server
+        self._loop = server.loop
+        self._index = server.next_index()
+        self._transport = None
+        self._session = None
+        self._state = _PENDING
+        self._heartbeat_timer = None
+        # Each scheduled heartbeat check has its own generation, so a
+        # check that was already due when it was rescheduled does nothing.
+        self._heartbeat_generation = 0
+        self._frames = FrameBuffer()
+
+    @property
+    def index(self):
+        return self._index
+
+    def _send(self, data: bytes):
+        # The session runs in the executor, so writes are
+        # scheduled back into the loop.
+        self._loop.call_soon_threadsafe(self._write, data)
+
+    def _write(self, data: bytes):
+        if self._transport and not self._transport.is_closing():
+            self._transport.write(data)
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self._transport = transport
+        self._session = PadSession(self._server.slots, self._index, self._send, self._server.broadcast,
+                                   self._server.coalesce, self._server.liveness, self._server.udp)
+        self._server.attach(self)
+        LOGGER.info(f"Remote #{self._index} starting")
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._frames.writable()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._frames.commit(nbytes)
+        self._transport.pause_reading()
+        future = self._loop.run_in_executor(self._server.executor, self._process, tracing.sample())
+        future.add_done_callback(self._processed)
+
+    def _process(self, received_at: Optional[int]) -> bool:
+        """
+        Processes all the complete commands received so far (runs in the executor).
+        :param received_at: When they were received, if they are traced.
+        :return: Whether the connection must keep being attended.
+        """
+
+        if self._state == _ENDED:
+            return False
+        try:
+            if self._state == _PENDING:
+                read = self._frames.take(AUTH_SIZE)
+                if read is None:
+                    return True
+                if not self._session.login(read):
+                    self._state = _ENDED
+                    return False
+                self._state = _LOGGED_IN
+                self._schedule_heartbeat()
+
+            self._session.received(received_at)
+            for length, commands in self._frames.frames():
+                if not self._session.process(length, commands):
+                    self._state = _ENDED
+                    return False
+            self._session.flush()
+            if self._session.timeout_dropped():
+                self._schedule_heartbeat()
+            return True
+        except Exception:
+            self._state = _ENDED
+            raise
+
+    def _processed(self, future: asyncio.Future) -> None:
+        try:
+            keep = future.result()
+        except Exception:
+            traceback.print_exc()
+            keep = False
+
+        if not self._transport or self._transport.is_closing():
+            return
+        if keep:
+            self._transport.resume_reading()
+        else:
+            self._transport.close()
+
+    def _schedule_heartbeat(self) -> None:
+        # This runs in the executor, and replaces the pending check (if any).
+        if self._heartbeat_timer:
+            self._heartbeat_timer.cancel()
+        self._heartbeat_generation += 1
+        self._heartbeat_timer = self._server.slots.timers.schedule(self._session.heartbeat_interval, self._heartbeat,
+                                                                   self._heartbeat_generation)
+
+    def _heartbeat(self, generation: int) -> None:
+        # This runs in the timers thread.
+        try:
+            self._server.executor.submit(self._check_heartbeat, generation)
+        except RuntimeError:
+            # The server is shutting down.
+            pass
+
+    def _check_heartbeat(self, generation: int) -> None:
+        if generation != self._heartbeat_generation:
+            return
+        if self._session.heartbeat():
+            self._schedule_heartbeat()
+        else:
+            self._state = _ENDED
+            self._loop.call_soon_threadsafe(self._close)
+
+    def _close(self) -> None:
+        if self._transport and not self._transport.is_closing():
+            self._transport.close()
+
+    def abort(self) -> None:
+        if self._transport:
+            self._transport.abort()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self._heartbeat_timer:
+            self._heartbeat_timer.cancel()
+        self._server.detach(self)
+        self._server.executor.submit(self._session.close)
+        LOGGER.info(f"Remote #{self._index} finished")
+
+
+class AsyncPadServer:
+    """
+    This server handles all the pads' commands in a single event loop,
+    instead of a thread per connection. It has the same interface as
+    the threaded PadServer regarding launching and stopping it.
+    """
+
+    def __init__(self, server_address: Tuple[str, int], RequestHandlerClass: Any,
+                 bind_and_activate: bool, broadcast_server: BroadcastServer, slots: PadSlots,
+                 coalesce: bool = False, liveness: Liveness = Liveness(), udp_port: int = 0):
+        self._slots = slots
+        self._coalesce = coalesce
+        self._liveness = liveness
+        self._broadcast_server = broadcast_server
+        self._protocol_class = RequestHandlerClass
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="virtualpad-uinput")
+        # The datagrams are processed in the executor as well.
+        self._udp = UdpChannel(udp_port, self._dispatch_datagram) if udp_port else None
+        self._protocols = set()
+        self._last_index = 0
+        self._stopped = threading.Event()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bind_and_activate:
+            self.socket.bind(server_address)
+            self.socket.listen()
+            if self._udp:
+                self._udp.start()
+            LOGGER.info("Server started")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @property
+    def coalesce(self):
+        return self._coalesce
+
+    @property
+    def liveness(self):
+        return self._liveness
+
+    @property
+    def udp(self):
+        return self._udp
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def executor(self):
+        return self._executor
+
+    def next_index(self) -> int:
+        value = self._last_index
+        self._last_index += 1
+        return value
+
+    def attach(self, protocol: PadProtocol):
+        self._protocols.add(protocol)
+
+    def detach(self, protocol: PadProtocol):
+        self._protocols.discard(protocol)
+
+    def broadcast(self, message: dict):
+        self._broadcast_server.broadcast(message, PAD)
+
+    def _dispatch_datagram(self, receive: Callable[[memoryview], Any], frame: memoryview):
+        # The channel reuses its buffer, so the frame is copied.
+        try:
+            self._executor.submit(receive, bytes(frame))
+        except RuntimeError:
+            # The server is shutting down.
+            pass
+
+    def serve_forever(self):
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(loop.create_server(lambda: self._protocol_class(self), sock=self.socket))
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            for protocol in list(self._protocols):
+                protocol.abort()
+            if self._udp:
+                self._udp.stop()
+            loop.run_until_complete(server.wait_closed())
+            # Let the closed connections release their pads.
+            loop.run_until_complete(asyncio.sleep(0))
+            self._executor.shutdown(wait=True)
+            self._stopped.set()
+
+    def shutdown(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._stopped.wait()
+
+    def server_close(self):
+        if self._udp:
+            self._udp.stop()
+        self.socket.close()
+        if not self._loop.is_running():
+            self._loop.close()
+        LOGGER.info("Server stopped")
+
+
+def launch_async_pad_server(broadcast_server: BroadcastServer, slots: PadSlots, coalesce: bool = False,
+                            liveness: Liveness = Liveness(), udp_port: int = 0) -> AsyncPadServer:
+    return launch_server_in_thread(AsyncPadServer, ("0.0.0.0", PAD_PORT), PadProtocol, broadcast_server, slots,
+                                   coalesce, liveness, udp_port)
@@ -1,109 +1,652 @@
+import collections
+import itertools
+import json
 import logging
-import queue
-import socketserver
+import selectors
+import socket
 import threading
-from typing import Any, Tuple, Dict, Type, NamedTuple
-from .base_server import IndexedHandler, IndexedTCPServer, launch_server_in_thread
+import time
+from typing import Any, Tuple, Dict, Deque, Optional, NamedTuple, List, Callable, FrozenSet
+from .base_server import launch_server_in_thread
+from .encoding import encode, JSON, FORMATS
+from .metrics import BYTES
 
 
 LOGGER = logging.getLogger("hawa.virtualpad.broadcast-server")
 LOGGER.setLevel(logging.INFO)
 BROADCAST_PORT = 2358
-_FINISH = object()
+# How many pending messages are sent in a single call.
+_MAX_BUFFERS_PER_SEND = 64
+_RECV_SIZE = 4096
+# Subscribers' commands are short JSON lines.
+_MAX_COMMAND_SIZE = 4096
+# How many of the latest messages are kept to be replayed.
+REPLAY_SIZE = 256
+# What to do when a subscriber's output buffer is full.
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+# Where the messages come from.
+ADMIN = "admin"
+PAD = "pad"
+STATE = "state"
+CATEGORIES = (ADMIN, PAD, STATE)
+# The high-rate categories are only sent to who asks for them.
+DEFAULT_CATEGORIES = (ADMIN, PAD)
 
 
-class BroadcastServerState(NamedTuple):
+class SubscriberLimits(NamedTuple):
     """
-    Settings for a server.
+    How many messages (and bytes) can be waiting to be sent to a
+    single subscriber, and what to do when a new message does not
+    fit in there.
     """
 
-    lock: threading.Lock
-    queues: Dict
+    max_messages: int = 1024
+    max_bytes: int = 1 << 20
+    policy: str = DROP_OLDEST
 
 
-class BroadcastHandler(IndexedHandler):
+class Topic(NamedTuple):
     """
-    Each handler goes into an infinite loop, ready to forward
-    any received message.
+    What a message is about: its category, its notification code,
+    and the index of the pad it refers to (if any).
     """
 
-    def __init__(self, request: Any, client_address: Any, server: socketserver.BaseServer):
-        if not isinstance(server, BroadcastServer):
-            raise ValueError("Only a BroadcastServer (or subclasses) can use a BroadcastHandler")
-        super().__init__(request, client_address, server)
-        self._queue = None
+    category: str
+    code: Optional[str]
+    index: Optional[int]
 
-    def setup(self) -> None:
-        super().setup()
-        with _STATES[self.server].lock:
-            self._queue = queue.Queue()
-            _STATES[self.server].queues[self] = self._queue
-        LOGGER.info(f"Remote #{self.index} starting")
+    @classmethod
+    def of(cls, category: str, message: dict) -> 'Topic':
+        # Some notifications tell their code in the "command" field.
+        return cls(category, message.get("code", message.get("command")), message.get("index"))
 
-    def handle(self) -> None:
+
+class Subscription(NamedTuple):
+    """
+    Which messages a subscriber is interested in. A None filter
+    matches everything, and the indices filter only applies to the
+    messages that refer to a pad.
+    """
+
+    categories: FrozenSet[str] = frozenset(DEFAULT_CATEGORIES)
+    codes: Optional[FrozenSet[str]] = None
+    indices: Optional[FrozenSet[int]] = None
+
+    def matches(self, topic: Topic) -> bool:
+        return (topic.category in self.categories and
+                (self.codes is None or topic.code in self.codes) and
+                (self.indices is None or topic.index is None or topic.index in self.indices))
+
+    def serialize(self) -> dict:
+        """
+        Returns this subscription, as a dictionary.
+        """
+
+        return {
+            "categories": sorted(self.categories),
+            "codes": None if self.codes is None else sorted(self.codes),
+            "indices": None if self.indices is None else sorted(self.indices),
+        }
+
+    @classmethod
+    def parse(cls, data: dict) -> 'Subscription':
+        """
+        Parses a subscription from a subscriber's command.
+        :param data: The command, with optional "categories", "codes",
+            and "indices" lists.
+        :return: The subscription.
+        """
+
+        categories = data.get("categories", list(DEFAULT_CATEGORIES))
+        if not isinstance(categories, list) or any(category not in CATEGORIES for category in categories):
+            raise ValueError(f"Invalid categories: {categories}")
+        codes = data.get("codes")
+        if codes is not None and (not isinstance(codes, list) or
+                                  not all(isinstance(code, str) for code in codes)):
+            raise ValueError(f"Invalid codes: {codes}")
+        indices = data.get("indices")
+        if indices is not None and (not isinstance(indices, list) or
+                                    not all(isinstance(index, int) for index in indices)):
+            raise ValueError(f"Invalid indices: {indices}")
+        return cls(frozenset(categories),
+                   None if codes is None else frozenset(codes),
+                   None if indices is None else frozenset(indices))
+
+
+class _Message:
+    """
+    A message, numbered unless it is not meant to be replayed. It is
+    encoded only when it is first sent (or replayed), and only once
+    per format.
+    """
+
+    __slots__ = ("seq", "topic", "obj", "_encoded")
+
+    def __init__(self, seq: Optional[int], topic: Topic, obj: dict):
+        self.seq = seq
+        self.topic = topic
+        self.obj = obj
+        self._encoded: Dict[str, bytes] = {}
+
+    def data(self, fmt: str) -> bytes:
+        data = self._encoded.get(fmt)
+        if data is None:
+            data = encode(self.obj if self.seq is None else dict(self.obj, seq=self.seq), fmt)
+            self._encoded[fmt] = data
+        return data
+
+
+class BroadcastHandler:
+    """
+    A single subscriber. It keeps its own output buffer with the
+    messages that could not be sent yet, and all of its sends are
+    non-blocking.
+    """
+
+    def __init__(self, sock: socket.socket, client_address: Any, index: int, limits: SubscriberLimits,
+                 first_seq: int):
+        self._socket = sock
+        self._input = bytearray()
+        self._first_seq = first_seq
+        self._subscription = Subscription()
+        self._format = JSON
+        self._client_address = client_address
+        self._index = index
+        self._limits = limits
+        self._pending: Deque[bytes] = collections.deque()
+        self._pending_bytes = 0
+        # How many bytes of the first pending message were sent.
+        self._offset = 0
+        self._connected_at = time.monotonic()
+        self._sent_messages = 0
+        self._dropped_messages = 0
+        self._dropped_bytes = 0
+        sock.setblocking(False)
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def socket(self):
+        return self._socket
+
+    @property
+    def client_address(self):
+        return self._client_address
+
+    @property
+    def first_seq(self):
+        """
+        The sequence number of the first message this subscriber
+        received live (i.e. not replayed).
+        """
+
+        return self._first_seq
+
+    @property
+    def subscription(self):
+        return self._subscription
+
+    @subscription.setter
+    def subscription(self, value: Subscription):
+        self._subscription = value
+
+    @property
+    def format(self):
+        return self._format
+
+    @format.setter
+    def format(self, value: str):
+        self._format = value
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def _overflows(self, size: int) -> bool:
+        return (len(self._pending) + 1 > self._limits.max_messages or
+                self._pending_bytes + size > self._limits.max_bytes)
+
+    def _drop_oldest(self) -> bool:
+        # A partially sent message cannot be dropped without
+        # breaking the stream, so the next one is dropped instead.
+        if self._offset:
+            if len(self._pending) < 2:
+                return False
+            dropped = self._pending[1]
+            del self._pending[1]
+        else:
+            if not self._pending:
+                return False
+            dropped = self._pending.popleft()
+        self._pending_bytes -= len(dropped)
+        self._dropped_messages += 1
+        self._dropped_bytes += len(dropped)
+        return True
+
+    def enqueue(self, message: bytes) -> bool:
+        """
+        Adds a message to the output buffer, applying the
+        overflow policy if the buffer is full.
+        :param message: The message.
+        :return: Whether the connection must be kept.
+        """
+
+        size = len(message)
+        if self._overflows(size):
+            if self._limits.policy == DISCONNECT:
+                LOGGER.warning(f"Remote #{self._index} is too slow. Disconnecting")
+                return False
+            if self._limits.policy == DROP_OLDEST:
+                while self._overflows(size) and self._drop_oldest():
+                    pass
+            if self._overflows(size):
+                # Either dropping the newest message or, still,
+                # not being able to make room for it.
+                self._dropped_messages += 1
+                self._dropped_bytes += size
+                return True
+        self._pending.append(message)
+        self._pending_bytes += size
+        return True
+
+    def flush(self) -> bool:
+        """
+        Makes a single non-blocking attempt to send the pending messages.
+        :return: Whether the connection is still alive.
+        """
+
+        if not self._pending:
+            return True
+        buffers = []
+        for message in self._pending:
+            buffers.append(memoryview(message)[self._offset:] if not buffers else message)
+            if len(buffers) == _MAX_BUFFERS_PER_SEND:
+                break
+        try:
+            sent = self._socket.sendmsg(buffers)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        BYTES.inc("broadcast", "out", amount=sent)
+        # Discard what was entirely sent, and remember how much
+        # of the (now) first message was sent.
+        self._pending_bytes -= sent
+        sent += self._offset
+        while self._pending and sent >= len(self._pending[0]):
+            sent -= len(self._pending.popleft())
+            self._sent_messages += 1
+        self._offset = sent
+        return True
+
+    def read(self) -> Optional[List[dict]]:
+        """
+        Reads what the subscriber sent: JSON commands, one per line.
+        :return: The complete commands received so far, or None if
+            the connection is closed, broken, or sent garbage.
+        """
+
+        try:
+            received = self._socket.recv(_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            return None
+        if not received:
+            return None
+        BYTES.inc("broadcast", "in", amount=len(received))
+        self._input += received
+        commands = []
         while True:
-            message = self._queue.get()
-            if message is _FINISH:
-                return
-            # Otherwise, the message will be a bytes instance.
-            # Failure to send this message will mean it closed.
+            end = self._input.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(self._input[:end]).strip()
+            del self._input[:end + 1]
+            if not line:
+                continue
             try:
-                self.wfile.write(message)
-            except:
-                # The connection closed or is broken.
-                return
+                command = json.loads(line.decode("utf-8"))
+            except ValueError:
+                return None
+            if not isinstance(command, dict):
+                return None
+            commands.append(command)
+        if len(self._input) > _MAX_COMMAND_SIZE:
+            return None
+        return commands
 
-    def finish(self) -> None:
-        super().finish()
-        LOGGER.info(f"Remote #{self.index} finished")
-        with _STATES[self.server].lock:
-            self._queue = None
-            _STATES[self.server].queues.pop(self, None)
+    def stats(self) -> dict:
+        """
+        Returns the counters of this subscriber. The lag is the amount
+        of messages (and bytes) waiting to be sent.
+        """
 
+        return {
+            "index": self._index,
+            "address": list(self._client_address) if self._client_address else None,
+            "connected_seconds": time.monotonic() - self._connected_at,
+            "subscription": self._subscription.serialize(),
+            "format": self._format,
+            "lag_messages": len(self._pending),
+            "lag_bytes": self._pending_bytes,
+            "sent_messages": self._sent_messages,
+            "dropped_messages": self._dropped_messages,
+            "dropped_bytes": self._dropped_bytes,
+        }
 
-class BroadcastServer(IndexedTCPServer):
+    def close(self):
+        self._pending.clear()
+        self._pending_bytes = 0
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+
+
+class BroadcastServer:
     """
-    Broadcasts a message to the clients.
+    Broadcasts a message to the clients. All the subscribers are
+    attended by a single thread, which multiplexes their sockets:
+    a broadcast enqueues the (already encoded) message once per
+    subscriber and makes one non-blocking send attempt on each of
+    them. What could not be sent stays in the subscriber's buffer
+    until its socket is writable again, up to the given limits.
+
+    Each message gets a sequence number, and the latest ones are
+    kept in a ring. A subscriber that reconnects can send a line
+    like {"command": "resume", "seq": N} to get the messages after
+    N it missed or, if they are not in the ring anymore, a snapshot
+    of the current state.
+
+    By default, subscribers get all admin and pad messages (state
+    frames are opt-in). They can send a line like {"command":
+    "subscribe", "codes": [...], "indices": [...], "categories":
+    [...]} to only get some of them. The subscribers
+    of each topic are computed once, and kept until a subscriber
+    connects, disconnects, or changes its subscription.
+
+    Subscribers can also send {"command": "format", "format": "binary"}
+    to get length-prefixed binary frames instead of JSON lines.
     """
 
     def __init__(
             self,
             server_address: Tuple[str, int],
-            RequestHandlerClass: Type[socketserver.BaseRequestHandler],
+            RequestHandlerClass: Any = BroadcastHandler,
             bind_and_activate: bool = True,
+            limits: SubscriberLimits = SubscriberLimits(),
+            replay_size: int = REPLAY_SIZE,
+            snapshot: Callable[[], dict] = dict,
+            watched: Callable[[FrozenSet[str]], Any] = None,
     ):
-        self._state = None
-        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        if limits.policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {limits.policy}")
+        self._handler_class = RequestHandlerClass
+        self._limits = limits
+        self._snapshot = snapshot
+        self._on_watched = watched
+        self._seq = 0
+        self._ring: Deque[_Message] = collections.deque(maxlen=replay_size)
+        self._targets: Dict[Topic, Tuple[BroadcastHandler, ...]] = {}
+        self._watched: FrozenSet[str] = frozenset()
+        self._lock = threading.Lock()
+        self._disconnected = 0
+        self._selector = selectors.DefaultSelector()
+        self._handlers: Dict[socket.socket, BroadcastHandler] = {}
+        self._inbox: Deque[Optional[Tuple[str, dict, bool]]] = collections.deque()
+        self._waker, self._wakeup = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wakeup.setblocking(False)
+        self._last_index = 0
+        self._running = False
+        self._stopped = threading.Event()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bind_and_activate:
+            self.socket.bind(server_address)
+            self.socket.listen()
+            LOGGER.info("Server started")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def _wake(self):
+        try:
+            self._waker.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # There's already a wakeup pending.
+            pass
+
+    def broadcast(self, message: dict, category: str = ADMIN, replay: bool = True) -> None:
+        """
+        Sends a message to the interested subscribers. It can be
+        invoked from any thread. The message is numbered and encoded
+        once, in the server's thread.
+        :param message: The message.
+        :param category: The message's category.
+        :param replay: Whether the message is numbered and kept to be
+            replayed. Transient (e.g. high-rate) messages are not.
+        """
+
+        if replay:
+            LOGGER.info(f"Broadcasting: {message}")
+        self._inbox.append((category, message, replay))
+        self._wake()
+
+    def has_subscribers(self, category: str) -> bool:
+        """
+        Tells whether any subscriber is interested in a category. It
+        can be invoked from any thread.
+        :param category: The category.
+        :return: Whether there are interested subscribers.
+        """
+
+        return category in self._watched
+
+    def _subscriptions_changed(self):
+        self._targets.clear()
+        watched = frozenset(category for handler in self._handlers.values()
+                            for category in handler.subscription.categories)
+        if watched != self._watched:
+            self._watched = watched
+            if self._on_watched:
+                self._on_watched(watched)
 
-    def server_activate(self) -> None:
-        super().server_activate()
-        self._state = _STATES.setdefault(self, BroadcastServerState(lock=threading.Lock(), queues={}))
-        LOGGER.info("Server started")
+    def _subscribers(self, topic: Topic) -> Tuple[BroadcastHandler, ...]:
+        targets = self._targets.get(topic)
+        if targets is None:
+            targets = tuple(handler for handler in self._handlers.values() if handler.subscription.matches(topic))
+            self._targets[topic] = targets
+        return targets
 
-    def _send_all(self, what: any) -> None:
-        if not self._state:
-            LOGGER.error("This server was cleared. There's no way to send messages")
+    def _accept(self):
+        try:
+            sock, client_address = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
             return
+        handler = self._handler_class(sock, client_address, self._last_index, self._limits, self._seq + 1)
+        self._last_index += 1
+        with self._lock:
+            self._handlers[sock] = handler
+        self._subscriptions_changed()
+        self._selector.register(sock, selectors.EVENT_READ, handler)
+        LOGGER.info(f"Remote #{handler.index} starting")
 
-        with self._state.lock:
-            for s, q in self._state.queues.items():
-                q.put(what)
+    def _drop(self, handler: BroadcastHandler):
+        self._selector.unregister(handler.socket)
+        with self._lock:
+            self._handlers.pop(handler.socket, None)
+        self._subscriptions_changed()
+        handler.close()
+        LOGGER.info(f"Remote #{handler.index} finished")
 
-    def broadcast(self, message: bytes) -> None:
-        LOGGER.info(f"Broadcasting: {message}")
-        self._send_all(message)
+    def _flush(self, handler: BroadcastHandler):
+        had_pending = handler.has_pending
+        if not handler.flush():
+            self._drop(handler)
+            return
+        # Only wait for the socket to be writable while
+        # there is something left to send.
+        if handler.has_pending != had_pending or handler.has_pending:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if handler.has_pending else 0)
+            self._selector.modify(handler.socket, events, handler)
 
-    def server_close(self) -> None:
-        LOGGER.info("Server stopping")
-        self._send_all(_FINISH)
-        super().server_close()
-        self._state = None
-        _STATES.pop(self, None)
-        LOGGER.info("Server stopped")
+    def _enqueue(self, handler: BroadcastHandler, data: bytes) -> bool:
+        if handler.enqueue(data):
+            return True
+        self._disconnected += 1
+        self._drop(handler)
+        return False
+
+    def _reply(self, handler: BroadcastHandler, obj: dict) -> bool:
+        return self._enqueue(handler, encode(obj, handler.format))
+
+    def _resume(self, handler: BroadcastHandler, seq: int):
+        # The messages from first_seq on were (or will be) sent
+        # live, so only the ones before are replayed.
+        last = handler.first_seq - 1
+        if seq >= last:
+            return
+        if self._ring and seq + 1 >= self._ring[0].seq:
+            start = seq + 1 - self._ring[0].seq
+            for message in itertools.islice(self._ring, start, start + last - seq):
+                if handler.subscription.matches(message.topic) and \
+                        not self._enqueue(handler, message.data(handler.format)):
+                    return
+        else:
+            self._reply(handler, {"type": "snapshot", "seq": self._seq, "value": self._snapshot()})
+
+    def _command(self, handler: BroadcastHandler, command: dict):
+        name = command.get("command")
+        if name == "resume":
+            seq = command.get("seq")
+            if isinstance(seq, int) and seq >= 0:
+                self._resume(handler, seq)
+            else:
+                self._reply(handler, {"type": "response", "code": "resume:invalid-seq", "value": seq})
+        elif name == "subscribe":
+            try:
+                handler.subscription = Subscription.parse(command)
+                self._subscriptions_changed()
+                self._reply(handler, {"type": "response", "code": "subscribe:ok",
+                                      "value": handler.subscription.serialize()})
+            except ValueError as e:
+                self._reply(handler, {"type": "response", "code": "subscribe:invalid", "value": str(e)})
+        elif name == "format":
+            fmt = command.get("format")
+            if fmt in FORMATS:
+                handler.format = fmt
+                self._reply(handler, {"type": "response", "code": "format:ok", "value": fmt})
+            else:
+                self._reply(handler, {"type": "response", "code": "format:invalid", "value": fmt})
+        else:
+            self._reply(handler, {"type": "response", "code": "unknown-command", "value": name})
+
+    def _read(self, handler: BroadcastHandler):
+        commands = handler.read()
+        if commands is None:
+            self._drop(handler)
+            return
+        for command in commands:
+            self._command(handler, command)
+            if handler.socket not in self._handlers:
+                return
+        if commands:
+            self._flush(handler)
+
+    def _dispatch(self):
+        try:
+            while self._wakeup.recv(_RECV_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        touched = set()
+        while self._inbox:
+            item = self._inbox.popleft()
+            if item is None:
+                self._running = False
+                return
+            category, obj, replay = item
+            if replay:
+                self._seq += 1
+                message = _Message(self._seq, Topic.of(category, obj), obj)
+                self._ring.append(message)
+            else:
+                message = _Message(None, Topic.of(category, obj), obj)
+            for handler in self._subscribers(message.topic):
+                if handler.socket not in self._handlers:
+                    continue
+                if self._enqueue(handler, message.data(handler.format)):
+                    touched.add(handler)
+                else:
+                    touched.discard(handler)
+        for handler in touched:
+            if handler.socket in self._handlers:
+                self._flush(handler)
+
+    def stats(self) -> dict:
+        """
+        Returns the limits, the per-subscriber counters, and how many
+        subscribers were disconnected for being too slow.
+        """
 
+        with self._lock:
+            subscribers: List[dict] = [handler.stats() for handler in self._handlers.values()]
+        return {
+            "limits": self._limits._asdict(),
+            "seq": self._seq,
+            "disconnected": self._disconnected,
+            "subscribers": subscribers,
+        }
 
-_STATES: Dict[BroadcastServer, BroadcastServerState] = {}
+    def serve_forever(self):
+        self.socket.setblocking(False)
+        self._selector.register(self.socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._running = True
+        try:
+            while self._running:
+                for key, events in self._selector.select():
+                    if key.fileobj is self.socket:
+                        self._accept()
+                    elif key.fileobj is self._wakeup:
+                        self._dispatch()
+                    elif key.fileobj in self._handlers:
+                        handler = key.data
+                        if events & selectors.EVENT_READ:
+                            self._read(handler)
+                        if events & selectors.EVENT_WRITE and handler.socket in self._handlers:
+                            self._flush(handler)
+        finally:
+            for handler in list(self._handlers.values()):
+                self._drop(handler)
+            self._selector.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        self._inbox.append(None)
+        self._wake()
+        self._stopped.wait()
+
+    def server_close(self):
+        LOGGER.info("Server stopping")
+        self.socket.close()
+        self._waker.close()
+        self._wakeup.close()
+        LOGGER.info("Server stopped")
 
 
-def launch_broadcast_server() -> socketserver.TCPServer:
-    return launch_server_in_thread(BroadcastServer, ("0.0.0.0", BROADCAST_PORT), BroadcastHandler)
+def launch_broadcast_server(limits: SubscriberLimits = SubscriberLimits(), replay_size: int = REPLAY_SIZE,
+                            snapshot: Callable[[], dict] = dict,
+                            watched: Callable[[FrozenSet[str]], Any] = None) -> BroadcastServer:
+    return launch_server_in_thread(BroadcastServer, ("0.0.0.0", BROADCAST_PORT), BroadcastHandler, limits,
+                                   replay_size, snapshot, watched)
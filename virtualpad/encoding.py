@@ -0,0 +1,112 @@
+import json
+import struct
+from typing import NamedTuple, Tuple, Dict, Callable, Any, Optional
+
+
+# The available message formats: JSON lines (the default), or
+# length-prefixed binary frames.
+JSON = "json"
+BINARY = "binary"
+FORMATS = (JSON, BINARY)
+# Each binary frame starts with the length of the rest of the frame
+# and the id of the schema of its payload.
+HEADER = struct.Struct("!IB")
+# The payload of this schema is the message as JSON. It is used for
+# all the messages without a fixed schema.
+GENERIC = 0
+
+
+class Schema(NamedTuple):
+    """
+    A fixed binary layout for a known message. A message matches it
+    when it has the given type and code (in the given key), and
+    exactly the given fields besides them.
+    """
+
+    id: int
+    type: str
+    code: str
+    fields: Tuple[str, ...]
+    layout: struct.Struct
+    # Some notifications tell their code in the "command" field.
+    code_key: str = "code"
+
+
+# The virtualpad-admin script keeps its own copy of these, to stay
+# standalone: keep both in sync.
+SCHEMAS = (
+    Schema(1, "notification", "pad:timeout", ("index", "seq"), struct.Struct("!BI"), "command"),
+    Schema(2, "notification", "pad:cleared", ("index", "seq"), struct.Struct("!BI")),
+    Schema(3, "notification", "pad:all-cleared", ("seq",), struct.Struct("!I")),
+    Schema(4, "notification", "pad:state", ("index", "state"), struct.Struct("!B18s")),
+    Schema(5, "response", "pad:ok", ("index",), struct.Struct("!B")),
+    Schema(6, "response", "pad:ok", (), struct.Struct("!")),
+    Schema(7, "response", "server:ok", (), struct.Struct("!")),
+    Schema(8, "response", "server:is-running", ("value",), struct.Struct("!?")),
+    Schema(9, "response", "server:already-running", (), struct.Struct("!")),
+    Schema(10, "response", "server:not-running", (), struct.Struct("!")),
+    Schema(11, "response", "pad:not-modified", ("version",), struct.Struct("!I")),
+)
+_BY_ID: Dict[int, Schema] = {schema.id: schema for schema in SCHEMAS}
+_BY_SHAPE: Dict[Tuple[str, str, str, frozenset], Schema] = {
+    (schema.type, schema.code_key, schema.code, frozenset(schema.fields)): schema for schema in SCHEMAS
+}
+# Fields that are not transported as-is.
+_TO_WIRE: Dict[str, Callable[[Any], Any]] = {"state": bytes.fromhex}
+_FROM_WIRE: Dict[str, Callable[[Any], Any]] = {"state": bytes.hex}
+
+
+def _schema_of(obj: dict) -> Optional[Schema]:
+    msg_type = obj.get("type")
+    for code_key in ("code", "command"):
+        code = obj.get(code_key)
+        if code is not None:
+            fields = frozenset(key for key in obj if key not in ("type", code_key))
+            return _BY_SHAPE.get((msg_type, code_key, code, fields))
+    return None
+
+
+def _encode_binary(obj: dict) -> bytes:
+    schema = _schema_of(obj)
+    if schema is not None:
+        try:
+            payload = schema.layout.pack(*(_TO_WIRE.get(field, lambda v: v)(obj[field])
+                                           for field in schema.fields))
+            return HEADER.pack(len(payload) + 1, schema.id) + payload
+        except (struct.error, ValueError, TypeError):
+            # Out-of-range values go in the generic way.
+            pass
+    payload = json.dumps(obj).encode("utf-8")
+    return HEADER.pack(len(payload) + 1, GENERIC) + payload
+
+
+def encode(obj: dict, fmt: str = JSON) -> bytes:
+    """
+    Encodes a message.
+    :param obj: The message.
+    :param fmt: The format: JSON or BINARY.
+    :return: The encoded message: a JSON line, or a binary frame.
+    """
+
+    if fmt == BINARY:
+        return _encode_binary(obj)
+    return f"{json.dumps(obj)}\n".encode("utf-8")
+
+
+def decode(frame: bytes) -> dict:
+    """
+    Decodes a binary frame (without the length prefix).
+    :param frame: The schema id and the payload.
+    :return: The message.
+    """
+
+    schema_id, payload = frame[0], frame[1:]
+    if schema_id == GENERIC:
+        return json.loads(bytes(payload).decode("utf-8"))
+    schema = _BY_ID.get(schema_id)
+    if schema is None:
+        raise ValueError(f"Unknown schema: {schema_id}")
+    obj = {"type": schema.type, schema.code_key: schema.code}
+    for field, value in zip(schema.fields, schema.layout.unpack(payload)):
+        obj[field] = _FROM_WIRE.get(field, lambda v: v)(value)
+    return obj
@@ -0,0 +1,143 @@
+import socket
+import struct
+from typing import Iterator, Tuple, Optional
+from .metrics import BYTES
+from .pads.devices import PACKED_STATE
+
+
+# Buttons are: D-Pad (4), B-Pad (4), Shoulders (4), Start/Select (2) and axes (4).
+N_BUTTONS = 18
+CLOSE_CONNECTION = N_BUTTONS + 1
+PING = N_BUTTONS + 2
+# A ping that carries the client's send time (in microseconds, by its
+# own clock), the send time of the last timed pong it received (or 0),
+# and for how many microseconds it held that pong before this ping.
+TIMED_PING = N_BUTTONS + 3
+TIMED_PING_PAYLOAD = struct.Struct("!QQI")
+# Asks for a token to send the input via UDP instead.
+UDP_OPEN = N_BUTTONS + 4
+# The whole state of the pad, packed (protocol v2 only).
+FULL_STATE = N_BUTTONS + 5
+
+# The biggest frame is a length byte and N_BUTTONS - 1 (key, state) pairs.
+MAX_FRAME_SIZE = 1 + (N_BUTTONS - 1) * 2
+BUFFER_SIZE = 4096
+# The size of the payload that follows each length byte.
+_PAYLOAD_SIZES = tuple(
+    length << 1 if length < N_BUTTONS else
+    TIMED_PING_PAYLOAD.size if length == TIMED_PING else
+    PACKED_STATE.size if length == FULL_STATE else 0
+    for length in range(256)
+)
+
+
+class FrameBuffer:
+    """
+    A preallocated, per-connection receive buffer. Data is received
+    straight into it (e.g. via `recv_into`) and the complete frames
+    are then given as memoryview slices over it, so no bytes object
+    is allocated per frame or per event. The given slices are only
+    valid until the next time the buffer is written to.
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        The amount of received bytes not yet consumed.
+        """
+
+        return self._end - self._start
+
+    def writable(self) -> memoryview:
+        """
+        Gets the free region of the buffer, to receive data into.
+        The unconsumed data is moved to the beginning, if needed.
+        :return: A memoryview over the free region.
+        """
+
+        start, end = self._start, self._end
+        if start == end:
+            self._start = self._end = 0
+        elif len(self._buffer) - end < MAX_FRAME_SIZE:
+            # Only an incomplete frame (or a few) may remain here.
+            self._buffer[:end - start] = self._buffer[start:end]
+            self._start, self._end = 0, end - start
+        return self._view[self._end:]
+
+    def commit(self, count: int):
+        """
+        Marks bytes as received in the region given by `writable`.
+        :param count: The amount of received bytes.
+        """
+
+        self._end += count
+        BYTES.inc("pad", "in", amount=count)
+
+    def recv_into(self, sock: socket.socket) -> int:
+        """
+        Receives data from a socket, straight into the buffer.
+        :param sock: The socket to receive the data from.
+        :return: The amount of received bytes (0 on EOF).
+        """
+
+        count = sock.recv_into(self.writable())
+        self._end += count
+        BYTES.inc("pad", "in", amount=count)
+        return count
+
+    def take(self, size: int) -> Optional[memoryview]:
+        """
+        Consumes a fixed amount of bytes, if available.
+        :param size: The amount of bytes to consume.
+        :return: A memoryview over those bytes, or None if not enough
+            bytes were received yet.
+        """
+
+        start = self._start
+        if self._end - start < size:
+            return None
+        self._start = start + size
+        return self._view[start:start + size]
+
+    def receive(self, sock: socket.socket, size: int) -> Optional[memoryview]:
+        """
+        Blocks until a fixed amount of bytes is received, and consumes them.
+        :param sock: The socket to receive the data from.
+        :param size: The amount of bytes to consume.
+        :return: A memoryview over those bytes, or None on EOF.
+        """
+
+        while self.pending < size:
+            if not self.recv_into(sock):
+                return None
+        return self.take(size)
+
+    def frames(self) -> Iterator[Tuple[int, memoryview]]:
+        """
+        Consumes all the complete frames received so far. Any trailing
+        incomplete frame is kept until the rest of it is received.
+        :return: An iterator of (length byte, payload) pairs. The payload
+            is empty for commands other than button/axis changes, full
+            states, and timed pings.
+        """
+
+        buffer = self._buffer
+        view = self._view
+        sizes = _PAYLOAD_SIZES
+        while True:
+            start = self._start
+            end = self._end
+            if start >= end:
+                return
+            length = buffer[start]
+            stop = start + 1 + sizes[length]
+            if stop > end:
+                return
+            self._start = stop
+            yield length, view[start + 1:stop]
@@ -1,19 +1,39 @@
 import json
 import logging
 import os.path
+import queue
+import select
+import socket
 import socketserver
-from typing import Type, Union, Dict, Any
+import threading
+from typing import Type, Union, Dict, Any, Set, Tuple, FrozenSet
 from .base_server import IndexedUnixServer, IndexedHandler, launch_server
-from .broadcast_server import launch_broadcast_server
-from .pad_server import launch_pad_server
-from .pads import PadSlots, PadNotInUse
+from .encoding import encode, JSON, FORMATS
+from .broadcast_server import launch_broadcast_server, SubscriberLimits, REPLAY_SIZE, ADMIN, STATE
+from .state_stream import PadStateStream, STATE_RATE
+from .pad_server import launch_pad_server, Liveness
+from .async_pad_server import launch_async_pad_server
+from .pads import PadSlots, PadNotInUse, PadIndexOutOfRange
+from .pads.retention import RetentionPolicy
 from .pads.settings import passwords_get, passwords_regenerate
+from .timers import Timers
+from . import metrics, tracing
 
 
 LOGGER = logging.getLogger("hawa.virtualpad.main-server")
 LOGGER.setLevel(logging.INFO)
 MAIN_BINDING = os.path.expanduser("/run/Hawa/virtualpad-admin.sock")
 GROUP = "hawamgmt"
+# How many change events can be waiting for a single watcher. A watcher
+# that falls behind that much is disconnected.
+_WATCH_QUEUE_SIZE = 1024
+# How often an idle watcher checks whether its client left.
+_WATCH_POLL_INTERVAL = 1.0
+# The available pad server implementations.
+PAD_SERVER_LAUNCHERS = {
+    "threaded": launch_pad_server,
+    "asyncio": launch_async_pad_server,
+}
 
 
 class MainServerState:
@@ -25,7 +45,9 @@ class MainServerState:
 
 class MainHandler(IndexedHandler):
     """
-    Attends a management command.
+    Attends management commands: one JSON object per line, as many
+    as needed in the same connection. If a command has an "id", the
+    response echoes it, so commands can be pipelined.
     """
 
     def __init__(self, request: Any, client_address: Any, server: socketserver.BaseServer):
@@ -34,13 +56,60 @@ class MainHandler(IndexedHandler):
         super().__init__(request, client_address, server)
 
     def _send(self, obj):
-        self.wfile.write(f"{json.dumps(obj)}\n".encode("utf-8"))
+        if self._request_id is not None:
+            obj = dict(obj, id=self._request_id)
+        self._write(encode(obj, self._format))
+
+    def _write(self, data: bytes):
+        metrics.BYTES.inc("admin", "out", amount=len(data))
+        self.wfile.write(data)
 
     def _broadcast(self, obj):
-        self.server.broadcast(f"{json.dumps(obj)}\n".encode("utf-8"))
+        self.server.broadcast(obj)
+
+    def _client_left(self) -> bool:
+        readable, _, _ = select.select([self.request], [], [], 0)
+        try:
+            return bool(readable) and not self.request.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def _watch(self):
+        """
+        Turns this connection into a push stream: a snapshot of the
+        pads and passwords, and then the changes of the pads, until
+        the client leaves.
+        """
+
+        watcher = queue.Queue(maxsize=_WATCH_QUEUE_SIZE)
+        # Registered before the snapshot, so no change is missed.
+        self.server.add_watcher(watcher)
+        try:
+            self._send({"type": "snapshot", "code": "pad:watch", "value": {
+                "pads": self.server.slots.serialize(),
+                "passwords": passwords_get()
+            }})
+            while True:
+                try:
+                    event = watcher.get(timeout=_WATCH_POLL_INTERVAL)
+                except queue.Empty:
+                    if self._client_left():
+                        return
+                    continue
+                if event is None:
+                    # Either the server is closing, or this watcher fell behind.
+                    return
+                self._send(event)
+        except OSError:
+            pass
+        finally:
+            self.server.remove_watcher(watcher)
 
     def setup(self) -> None:
         super().setup()
+        # Responses are JSON lines unless the command asks otherwise.
+        self._format = JSON
+        self._request_id = None
         LOGGER.info(f"Admin #{self.index} starting")
 
     def finish(self) -> None:
@@ -48,20 +117,39 @@ class MainHandler(IndexedHandler):
         super().finish()
 
     def handle(self) -> None:
-        state = _STATES[self.server]
         assert isinstance(self.server, MainServer)
 
-        line = self.rfile.readline()
-        if len(line) == 0:
+        while True:
+            line = self.rfile.readline()
+            if len(line) == 0:
+                return
+            metrics.BYTES.inc("admin", "in", amount=len(line))
+            line = line.strip()
+            if line:
+                self._process(line)
+
+    def _process(self, line: bytes):
+        state = _STATES[self.server]
+        self._format = JSON
+        self._request_id = None
+
+        try:
+            payload = json.loads(line.decode("utf-8"))
+            if not isinstance(payload, dict):
+                raise ValueError("Commands must be objects")
+        except ValueError:
+            self._send({"type": "response", "code": "invalid-command"})
             return
 
         try:
-            payload = json.loads(line.decode("utf-8").strip())
             command = payload.get("command")
+            self._request_id = payload.get("id")
+            if payload.get("format") in FORMATS:
+                self._format = payload["format"]
 
             if command == "server:start":
                 if not state.pad_server:
-                    state.pad_server = launch_pad_server(_STATES[self.server].broadcast_server)
+                    state.pad_server = self.server.launch_pad_server()
                     self._send({"type": "response", "code": "server:ok", "status": self.server.slots.serialize()})
                 else:
                     self._send({"type": "response", "code": "server:already-running"})
@@ -92,19 +180,54 @@ class MainHandler(IndexedHandler):
                 self._send({"type": "response", "code": "pad:ok"})
                 self._broadcast({"type": "notification", "code": "pad:all-cleared"})
             elif command == "pad:status":
-                self._send({"type": "response", "code": "pad:status", "value": {
-                    "pads": self.server.slots.serialize(),
-                    "passwords": passwords_get()
+                status, data = self.server.status(self._format)
+                if payload.get("version") == status["version"]:
+                    self._send({"type": "response", "code": "pad:not-modified", "version": status["version"]})
+                elif self._request_id is None:
+                    self._write(data)
+                else:
+                    self._send(status)
+            elif command == "pad:stats":
+                self._send({"type": "response", "code": "pad:stats", "value": {
+                    "pads": self.server.slots.stats(), "links": self.server.slots.round_trips()
                 }})
+            elif command == "pad:retention":
+                policy = payload.get("policy")
+                if policy is not None:
+                    try:
+                        self.server.slots.set_retention(RetentionPolicy.parse(policy), *payload.get("indices", ()))
+                    except (ValueError, PadIndexOutOfRange) as e:
+                        self._send({"type": "response", "code": "pad:invalid-retention", "value": str(e)})
+                        return
+                self._send({"type": "response", "code": "pad:retention", "value": {
+                    "pads": self.server.slots.retention()
+                }})
+            elif command == "pad:latency":
+                self._send({"type": "response", "code": "pad:latency", "value": tracing.report()})
+                if payload.get("reset"):
+                    tracing.reset()
+            elif command == "metrics":
+                self._send({"type": "response", "code": "metrics", "value": {
+                    "enabled": metrics.enabled(),
+                    "samples": metrics.samples()
+                }})
+            elif command == "broadcast:stats":
+                self._send({"type": "response", "code": "broadcast:stats",
+                            "value": self.server.broadcast_stats()})
+            elif command == "pad:watch":
+                self._watch()
             elif command == "pad:reset-passwords":
                 passwords_regenerate(*payload.get("indices", ()))
+                passwords = passwords_get()
                 self._send({"type": "response", "code": "ok", "value": {
-                    "passwords": passwords_get()
+                    "passwords": passwords
                 }})
+                self.server.notify_watchers({"type": "notification", "code": "pad:passwords", "value": passwords})
             else:
                 self._send({"type": "response", "code": "unknown-command", "value": command})
         except:
             LOGGER.exception("An error on command processing has occurred!")
+            self._send({"type": "response", "code": "error"})
 
 
 class MainServer(IndexedUnixServer):
@@ -115,18 +238,56 @@ class MainServer(IndexedUnixServer):
     - Attends management commands.
     """
 
+    # Admin connections may stay open, idle, so they must not
+    # keep the server from closing.
+    daemon_threads = True
+    block_on_close = False
+
     def __init__(
             self,
             server_address: Union[str, bytes],
             RequestHandlerClass: Type[socketserver.BaseRequestHandler],
-            bind_and_activate: bool = True
+            bind_and_activate: bool = True,
+            pad_server_mode: str = "threaded",
+            coalesce: bool = False,
+            liveness: Liveness = Liveness(),
+            udp_port: int = 0,
+            prewarm: int = 0,
+            broadcast_limits: SubscriberLimits = SubscriberLimits(),
+            broadcast_replay: int = REPLAY_SIZE,
+            state_rate: float = STATE_RATE,
+            metrics_port: int = 0
     ):
+        if pad_server_mode not in PAD_SERVER_LAUNCHERS:
+            raise ValueError(f"Invalid pad server mode: {pad_server_mode}")
         try:
             os.unlink(server_address)
         except:
             pass
-        self._slots = PadSlots()
+        self._timers = Timers()
+        self._slots = PadSlots(self._timers, prewarm)
+        self._slots.add_listener(self._on_pad_changed)
+        self._watchers: Set[queue.Queue] = set()
+        self._watchers_lock = threading.Lock()
+        # The pad:status response is kept, and encoded once per format,
+        # until the pads or the passwords change.
+        self._status_lock = threading.Lock()
+        self._status_key = None
+        self._status_version = 0
+        self._status = None
+        self._status_encoded: Dict[str, bytes] = {}
         self._settings = None
+        self._pad_server_mode = pad_server_mode
+        self._coalesce = coalesce
+        self._liveness = liveness
+        self._udp_port = udp_port
+        self._broadcast_limits = broadcast_limits
+        self._broadcast_replay = broadcast_replay
+        self._metrics_port = metrics_port
+        self._metrics_server = None
+        self._state_stream = None
+        if state_rate > 0:
+            self._state_stream = PadStateStream(self._slots, self._timers, self._publish_state, state_rate)
         os.makedirs(os.path.dirname(server_address), 0o755, exist_ok=True)
         LOGGER.info(f"Binding main server to: {server_address}")
         super().__init__(server_address, RequestHandlerClass, bind_and_activate)
@@ -140,27 +301,141 @@ class MainServer(IndexedUnixServer):
         os.system(f"chgrp {GROUP} {MAIN_BINDING}")
         os.system(f"chmod g+rw {MAIN_BINDING}")
         os.system(f"chmod o-rwx {MAIN_BINDING}")
+        self._timers.start()
+        self._slots.warm_up()
         self._settings = _STATES.setdefault(self, MainServerState())
-        self._settings.broadcast_server = launch_broadcast_server()
-        self._settings.pad_server = launch_pad_server(self._settings.broadcast_server, self._slots)
+        self._settings.broadcast_server = launch_broadcast_server(self._broadcast_limits, self._broadcast_replay,
+                                                                self._broadcast_snapshot, self._on_watched)
+        if self._state_stream:
+            self._state_stream.start()
+        metrics.BROADCAST_LAG_MESSAGES.set_function(lambda: self._broadcast_lag("lag_messages"))
+        metrics.BROADCAST_LAG_BYTES.set_function(lambda: self._broadcast_lag("lag_bytes"))
+        if self._metrics_port:
+            self._metrics_server = metrics.launch_metrics_server(self._metrics_port)
+        self._settings.pad_server = self.launch_pad_server()
         LOGGER.info("Server started")
 
+    def launch_pad_server(self):
+        """
+        Launches a pad server of the configured mode.
+        :return: The pad server instance.
+        """
+
+        LOGGER.info(f"Launching a {self._pad_server_mode} pad server")
+        return PAD_SERVER_LAUNCHERS[self._pad_server_mode](self._settings.broadcast_server, self._slots,
+                                                           self._coalesce, self._liveness, self._udp_port)
+
     def server_close(self) -> None:
         super().server_close()
         if self._settings and self._settings.broadcast_server:
             self._settings.broadcast_server.shutdown()
         self._settings = None
+        if self._metrics_server:
+            self._metrics_server.shutdown()
+            self._metrics_server = None
+        metrics.BROADCAST_LAG_MESSAGES.set_function(None)
+        metrics.BROADCAST_LAG_BYTES.set_function(None)
+        with self._watchers_lock:
+            for watcher in self._watchers:
+                self._stop_watcher(watcher)
+            self._watchers.clear()
+        if self._state_stream:
+            self._state_stream.stop()
+        self._timers.stop()
         _STATES.pop(self, None)
         LOGGER.info("Server stopped")
 
-    def broadcast(self, message: bytes):
+    def broadcast(self, message: dict):
         if not self._settings or not self._settings.broadcast_server:
             LOGGER.info("Cannot broadcast anything. The broadcast server is not running")
-        self._settings.broadcast_server.broadcast(message)
+            return
+        self._settings.broadcast_server.broadcast(message, ADMIN)
+
+    def status(self, fmt: str = JSON) -> Tuple[dict, bytes]:
+        """
+        Gets the pad:status response, and its encoding. Both are cached
+        until the pads or the passwords change, and then the response
+        gets a new version.
+        :param fmt: The format to encode the response in.
+        :return: The response, and its encoding.
+        """
+
+        passwords = passwords_get()
+        key = (self._slots.version, tuple(passwords))
+        with self._status_lock:
+            if key != self._status_key:
+                self._status_key = key
+                self._status_version += 1
+                self._status = {"type": "response", "code": "pad:status", "version": self._status_version,
+                                "value": {"pads": self._slots.serialize(), "passwords": list(passwords)}}
+                self._status_encoded = {}
+            data = self._status_encoded.get(fmt)
+            if data is None:
+                data = encode(self._status, fmt)
+                self._status_encoded[fmt] = data
+            return self._status, data
+
+    def add_watcher(self, watcher: queue.Queue):
+        with self._watchers_lock:
+            self._watchers.add(watcher)
+
+    def remove_watcher(self, watcher: queue.Queue):
+        with self._watchers_lock:
+            self._watchers.discard(watcher)
+
+    @staticmethod
+    def _stop_watcher(watcher: queue.Queue):
+        with watcher.mutex:
+            watcher.queue.clear()
+        watcher.put_nowait(None)
+
+    def notify_watchers(self, event: dict):
+        """
+        Pushes an event to all the admin watchers.
+        :param event: The event.
+        """
+
+        with self._watchers_lock:
+            for watcher in list(self._watchers):
+                try:
+                    watcher.put_nowait(event)
+                except queue.Full:
+                    LOGGER.warning("An admin watcher is too slow. Disconnecting")
+                    self._watchers.discard(watcher)
+                    self._stop_watcher(watcher)
+
+    def _on_pad_changed(self, pad_index: int, reason: str, status: Tuple[str, str]):
+        self.notify_watchers({"type": "notification", "code": "pad:changed", "index": pad_index,
+                              "reason": reason, "status": status})
+
+    def _publish_state(self, message: dict):
+        if self._settings and self._settings.broadcast_server:
+            self._settings.broadcast_server.broadcast(message, STATE, replay=False)
+
+    def _on_watched(self, categories: FrozenSet[str]):
+        # This runs in the broadcast server's thread.
+        if self._state_stream:
+            self._state_stream.watch(STATE in categories)
+
+    def _broadcast_snapshot(self) -> dict:
+        return {"pads": self._slots.serialize()}
+
+    def _broadcast_lag(self, key: str) -> Dict[Tuple[int], int]:
+        return {(subscriber["index"],): subscriber[key]
+                for subscriber in self.broadcast_stats().get("subscribers", ())}
+
+    def broadcast_stats(self) -> dict:
+        if not self._settings or not self._settings.broadcast_server:
+            return {}
+        return self._settings.broadcast_server.stats()
 
 
 _STATES: Dict[MainServer, MainServerState] = {}
 
 
-def launch_main_server():
-    return launch_server(MainServer, MAIN_BINDING, MainHandler)
+def launch_main_server(pad_server_mode: str = "threaded", coalesce: bool = False, liveness: Liveness = Liveness(),
+                       udp_port: int = 0, prewarm: int = 0, broadcast_limits: SubscriberLimits = SubscriberLimits(),
+                       broadcast_replay: int = REPLAY_SIZE, state_rate: float = STATE_RATE, metrics_port: int = 0):
+    return launch_server(MainServer, MAIN_BINDING, MainHandler, pad_server_mode=pad_server_mode, coalesce=coalesce,
+                         liveness=liveness, udp_port=udp_port, prewarm=prewarm, broadcast_limits=broadcast_limits,
+                         broadcast_replay=broadcast_replay, state_rate=state_rate, metrics_port=metrics_port)
@@ -0,0 +1,248 @@
+import abc
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple, Dict, List, Callable, Optional, Any
+from .base_server import launch_server_in_thread
+
+
+LOGGER = logging.getLogger("hawa.virtualpad.metrics")
+LOGGER.setLevel(logging.INFO)
+METRICS_PORT = 9357
+# Whether the metrics are recorded. When they are not, recording
+# them costs a single check.
+_ENABLED = False
+_METRICS: List['_Metric'] = []
+
+# Label values are only formatted when collected, so the hot paths
+# can give them as they are (e.g. pad indices, as integers).
+LabelValues = Tuple[Any, ...]
+
+
+def enable(value: bool = True):
+    """
+    Enables (or disables) recording the metrics.
+    :param value: Whether to record them.
+    """
+
+    global _ENABLED
+    _ENABLED = value
+
+
+def enabled() -> bool:
+    """
+    Tells whether the metrics are being recorded.
+    """
+
+    return _ENABLED
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues) -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _by_labels(item: Tuple[LabelValues, float]) -> str:
+    return str(item[0])
+
+
+class _Metric(abc.ABC):
+    """
+    The base of all the metrics: a name, a help text, and the names of
+    its labels. Metrics register themselves when created.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        _METRICS.append(self)
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, float]]:
+        """
+        Gets the current samples, as (name with labels, value) pairs.
+        """
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing counter, per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *values: Any, amount: float = 1):
+        """
+        Increases the counter, if recording is enabled.
+        :param values: The label values.
+        :param amount: How much to increase it.
+        """
+
+        if not _ENABLED:
+            return
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def samples(self) -> List[Tuple[str, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name + _format_labels(self.labels, values), value) for values, value in sorted(items, key=_by_labels)]
+
+
+class Histogram(_Metric):
+    """
+    Observations counted in fixed buckets, plus their sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...]):
+        super().__init__(name, description)
+        self._lock = threading.Lock()
+        self._buckets = tuple(sorted(buckets))
+        # The last count is for the observations above all the buckets.
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        """
+        Records an observation, if recording is enabled.
+        :param value: The observed value.
+        """
+
+        if not _ENABLED:
+            return
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def samples(self) -> List[Tuple[str, float]]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        accumulated = 0
+        for bound, count in zip(self._buckets, counts):
+            accumulated += count
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', accumulated))
+        accumulated += counts[-1]
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', accumulated))
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", accumulated))
+        return samples
+
+
+class Gauge(_Metric):
+    """
+    A value read when the metrics are collected, from a function that
+    gives it per combination of label values.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+
+    def set_function(self, function: Optional[Callable[[], Dict[LabelValues, float]]]):
+        """
+        Sets the function that gives the values.
+        :param function: The function, or None to clear it.
+        """
+
+        self._function = function
+
+    def samples(self) -> List[Tuple[str, float]]:
+        function = self._function
+        if function is None:
+            return []
+        try:
+            values = function()
+        except Exception:
+            LOGGER.exception(f"The gauge {self.name} could not be read")
+            return []
+        return [(self.name + _format_labels(self.labels, key), value) for key, value in sorted(values.items(), key=_by_labels)]
+
+
+FRAMES_RECEIVED = Counter("virtualpad_frames_received_total", "Frames received, per pad", ("pad",))
+EVENTS_RECEIVED = Counter("virtualpad_events_received_total", "Input events received, per pad", ("pad",))
+BYTES = Counter("virtualpad_bytes_total", "Bytes received and sent, per server", ("server", "direction"))
+AUTH = Counter("virtualpad_auth_total", "Pad login attempts, per result", ("result",))
+HEARTBEAT_TIMEOUTS = Counter("virtualpad_heartbeat_timeouts_total", "Pads released for not pinging")
+DEVICES_CREATED = Counter("virtualpad_devices_created_total", "Devices created, per pad", ("pad",))
+DEVICES_DESTROYED = Counter("virtualpad_devices_destroyed_total", "Devices destroyed, per pad", ("pad",))
+UDP_DROPPED = Counter("virtualpad_udp_dropped_total", "Pad datagrams dropped, per reason", ("reason",))
+BROADCAST_LAG_MESSAGES = Gauge("virtualpad_broadcast_lag_messages", "Messages waiting to be sent, per subscriber",
+                               ("subscriber",))
+BROADCAST_LAG_BYTES = Gauge("virtualpad_broadcast_lag_bytes", "Bytes waiting to be sent, per subscriber",
+                            ("subscriber",))
+EMIT_SECONDS = Histogram("virtualpad_emit_seconds", "Time spent writing the events of an update to a device",
+                         (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+
+
+def samples() -> Dict[str, float]:
+    """
+    Collects all the metrics.
+    :return: A dictionary of (name with labels) -> value.
+    """
+
+    return {name: value for metric in _METRICS for name, value in metric.samples()}
+
+
+def exposition() -> str:
+    """
+    Collects all the metrics, in the Prometheus text format.
+    :return: The text.
+    """
+
+    lines = []
+    for metric in _METRICS:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics, in the Prometheus text format, on /metrics.
+    """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # Scrapes are too frequent to be logged.
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    A local scrape endpoint for the metrics.
+    """
+
+    daemon_threads = True
+
+
+def launch_metrics_server(port: int = METRICS_PORT) -> MetricsServer:
+    LOGGER.info(f"Serving metrics on 127.0.0.1:{port}")
+    return launch_server_in_thread(MetricsServer, ("127.0.0.1", port), MetricsHandler)
@@ -1,12 +1,20 @@
-import json
 import time
+import socket
+import struct
 import logging
 import threading
 import socketserver
 import traceback
-from typing import Any, Type, Tuple
+from typing import Any, Type, Tuple, Callable, Union, Optional, NamedTuple
 from .base_server import IndexedTCPServer, IndexedHandler, launch_server_in_thread
-from .broadcast_server import BroadcastServer
+from .broadcast_server import BroadcastServer, PAD
+from .frames import FrameBuffer, N_BUTTONS, CLOSE_CONNECTION, PING, TIMED_PING, TIMED_PING_PAYLOAD, UDP_OPEN, \
+    FULL_STATE
+from .metrics import AUTH, BYTES, FRAMES_RECEIVED, EVENTS_RECEIVED, HEARTBEAT_TIMEOUTS, UDP_DROPPED
+from .udp_channel import UdpChannel
+from . import tracing
+from .pads.link import Cadence, RoundTrip
+from .pads.devices import PACKED_STATE
 from .pads import PadSlots, SLOTS_INDICES, PadNotInUse, PadIndexOutOfRange, PadInUse, AuthenticationFailed, PadMismatch
 
 # Logger and settings.
@@ -18,181 +26,552 @@ PAD_PORT = 2357
 LOGIN_SUCCESS = bytes([0])
 LOGIN_FAILURE = bytes([1])
 PAD_INVALID = bytes([2])
+# A successful login that accepted the protocol v2 (i.e. full state frames).
+LOGIN_SUCCESS_V2 = bytes([3])
 PAD_BUSY = bytes([4])
 TERMINATED = bytes([5])
 COMMAND_LENGTH_MISMATCH = bytes([6])
 PONG = bytes([7])
 TIMEOUT = bytes([8])
-
-# This variable checks whether the pad responded to the last ping command
-# or not (this is checked per-pad).
+# The answer to a timed ping: this byte, and then the echoed client
+# send time, and the server's receive and send times (in microseconds
+# since the epoch). With them, the client computes the round trip time,
+# (t4 - t1) - (t3 - t2), and how much the server's clock is ahead of its own,
+# ((t2 - t1) + (t3 - t4)) / 2.
+TIMED_PONG = bytes([9])
+TIMED_PONG_PAYLOAD = struct.Struct("!QQQ")
+# The answer to a UDP request: this byte, and then the session token
+# and the UDP port to send the datagrams to. Or, when the server does
+# not take input via UDP, just the other byte.
+UDP_TOKEN = bytes([10])
+UDP_TOKEN_PAYLOAD = struct.Struct("!QH")
+UDP_UNAVAILABLE = bytes([11])
+
+# How often pads are assumed to ping until their cadence is measured.
 _HEARTBEAT_INTERVAL = 10
+# Checks are not scheduled closer than this, in seconds.
+_MIN_CHECK_DELAY = 0.05
 
-# Buttons are: D-Pad (4), B-Pad (4), Shoulders (4), Start/Select (2) and axes (4).
-N_BUTTONS = 18
-CLOSE_CONNECTION = N_BUTTONS + 1
-PING = N_BUTTONS + 2
+# Auth messages are: pad index (1), password (4), nickname (16) and the
+# protocol version (1). Any version byte other than 2 means version 1.
+AUTH_SIZE = 22
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
 
 
-def _pad_auth(remote: 'PadHandler'):
+class Liveness(NamedTuple):
     """
-    Reads (receives) and parses a pad auth message.
-    :param remote: The remote to receive it from.
-    :return: The received and parsed data.
+    How long a pad may stay silent (i.e. send no frame at all) before
+    it is released. The timeout adapts to each connection: it allows
+    for one missed ping (at the measured ping interval) plus the
+    variation of that interval and of the round trip time, and then
+    it is kept between a floor and a ceiling.
     """
 
-    # Getting the first data.
-    read = remote.rfile.read(22)
-    if len(read) < 22:
+    floor: float = 5.0
+    ceiling: float = 30.0
+
+    def timeout(self, cadence: Cadence, round_trip: RoundTrip) -> float:
+        """
+        Computes the timeout of a connection.
+        :param cadence: The connection's ping cadence.
+        :param round_trip: The connection's round trip time.
+        :return: The timeout, in seconds.
+        """
+
+        if cadence.interval is None:
+            interval, deviation = _HEARTBEAT_INTERVAL, 0.0
+        else:
+            interval, deviation = cadence.interval, cadence.deviation
+        timeout = 2 * interval + 4 * deviation + round_trip.grace()
+        return min(max(timeout, self.floor), self.ceiling)
+
+
+def _pad_auth(slots: PadSlots, read: Union[bytes, memoryview], connection_index: int,
+              send: Callable[[bytes], Any]) -> Tuple[int, int]:
+    """
+    Parses a pad auth message and attempts to occupy the pad.
+    :param slots: The slots to occupy the pad from.
+    :param read: The received auth message.
+    :param connection_index: The index of the connection that attempts this.
+    :param send: The function used to send the response back.
+    :return: The occupied pad index, and the protocol version.
+    """
+
+    if len(read) < AUTH_SIZE:
         raise RuntimeError("Login handshake incomplete or aborted")
 
     pad_index = read[0]
     attempted = bytes(read[1:5]).decode("utf-8")
     nickname = bytes(read[5:21]).decode("utf-8").rstrip('\b')
+    version = PROTOCOL_V2 if read[21] == PROTOCOL_V2 else PROTOCOL_V1
     LOGGER.info(f"For pad index {pad_index}, '{nickname}' attempts to join")
     try:
-        remote.slots.occupy(pad_index, nickname, attempted, remote.index)
-        remote.wfile.write(LOGIN_SUCCESS)
-        return pad_index
+        slots.occupy(pad_index, nickname, attempted, connection_index)
+        AUTH.inc("success")
+        send(LOGIN_SUCCESS_V2 if version == PROTOCOL_V2 else LOGIN_SUCCESS)
+        return pad_index, version
     except PadIndexOutOfRange:
-        remote.wfile.write(PAD_INVALID)
+        AUTH.inc("PadIndexOutOfRange")
+        send(PAD_INVALID)
         raise
     except PadInUse:
-        remote.wfile.write(PAD_BUSY)
+        AUTH.inc("PadInUse")
+        send(PAD_BUSY)
         raise
     except AuthenticationFailed:
-        remote.wfile.write(LOGIN_FAILURE)
+        AUTH.inc("AuthenticationFailed")
+        send(LOGIN_FAILURE)
         raise
 
 
-class PadHandler(IndexedHandler):
+class PadSession:
+    """
+    The protocol state of a single pad connection. It performs no
+    I/O by itself: the transport gives it the received data, and it
+    answers through the `send` function. This way, the same protocol
+    is shared by both the threaded and the asyncio pad servers.
+
+    Frames received via UDP are processed in the channel's thread, so
+    the transport must hold the session's lock while it gives it data
+    from other threads (the asyncio server, processing everything in
+    its single executor, needs not).
+    """
 
-    def __init__(self, request: Any, client_address: Any, server: socketserver.BaseServer):
-        self._has_ping = False
+    def __init__(self, slots: PadSlots, connection_index: int, send: Callable[[bytes], Any],
+                 broadcast: Callable[[dict], Any], coalesce: bool = False, liveness: Liveness = Liveness(),
+                 udp: Optional[UdpChannel] = None):
+        self._slots = slots
+        self._coalesce = coalesce
+        self._connection_index = connection_index
+        self._send_raw = send
+        self._broadcast = broadcast
         self._pad_index = None
-        self._nickname = None
-        if not isinstance(server, PadServer):
-            raise ValueError("Only a MainServer (or subclasses) can use a PadHandler")
-        self._slots = server.slots
-        super().__init__(request, client_address, server)
+        self._version = PROTOCOL_V1
+        # When anything was last received, and the cadence of the pings.
+        self._liveness = liveness
+        self._last_seen = time.monotonic()
+        self._cadence = Cadence()
+        # The timeout the next heartbeat check was scheduled by, and
+        # whether pings (which may change it) were received since.
+        self._scheduled_timeout = None
+        self._pinged = False
+        # Whether the pad timed out, and the transport still has to tell it.
+        self._timeout_pending = False
+        # The UDP session, if the pad asked for one.
+        self._udp = udp
+        self._udp_token = None
+        # When the batch being processed was received, if it is traced.
+        self._received_at = None
+        self._lock = threading.Lock()
 
     @property
-    def slots(self):
-        return self._slots
-
-    def _send(self, obj):
-        self.wfile.write(f"{json.dumps(obj)}\n".encode("utf-8"))
+    def pad_index(self):
+        return self._pad_index
 
-    def _broadcast(self, obj):
-        self.server.broadcast(f"{json.dumps(obj)}\n".encode("utf-8"))
-
-    def _heartbeat(self) -> None:
+    @property
+    def lock(self) -> threading.Lock:
         """
-        Heartbeat for the gamepad.
+        Serializes the processing of the TCP data against the one of
+        the UDP frames (process_datagram takes it by itself).
         """
 
-        while self._pad_index in SLOTS_INDICES and self._slots[self._pad_index].connection_index == self.index:
-            time.sleep(_HEARTBEAT_INTERVAL)
-            if self._has_ping:
-                self._has_ping = False
-            else:
-                if self._pad_index is not None:
-                    self._broadcast({"type": "notification", "command": "pad:timeout", "index": self._pad_index})
-                    try:
-                        self.wfile.write(TIMEOUT)
-                        self._slots.release(self._pad_index, False, self.index, False)
-                    except PadNotInUse:
-                        pass
-                self._device = None
-                break
+        return self._lock
+
+    def _send(self, data: bytes):
+        BYTES.inc("pad", "out", amount=len(data))
+        self._send_raw(data)
 
-    def _init_pad(self) -> None:
+    def login(self, read: Union[bytes, memoryview]) -> bool:
         """
-        Attempts an authentication. On success, it establishes the _pad_index
-        to a value other than None. On failure, it keeps _pad_index == None.
-        The heartbeat is already launched on success.
+        Attempts an authentication. On success, it establishes the pad_index
+        to a value other than None. On failure, it keeps pad_index == None.
+        :param read: The received auth message.
+        :return: Whether the login was successful.
         """
 
-        LOGGER.info(f"Remote #{self.index} Logging in")
+        LOGGER.info(f"Remote #{self._connection_index} Logging in")
         try:
-            self._pad_index = _pad_auth(self)
-            threading.Thread(target=self._heartbeat).start()
-            LOGGER.info(f"Remote #{self.index} successfully logged in")
+            self._pad_index, self._version = _pad_auth(self._slots, read, self._connection_index, self._send)
+            self._last_seen = time.monotonic()
+            LOGGER.info(f"Remote #{self._connection_index} successfully logged in")
+            return True
         except Exception as e:
-            LOGGER.info(f"Remote #{self.index} failed to log in: {type(e).__name__} -> {e}")
+            LOGGER.info(f"Remote #{self._connection_index} failed to log in: {type(e).__name__} -> {e}")
+            return False
 
-    def _process_events(self, buffer: bytes):
+    def received(self, stamp: Optional[int]):
         """
-        Sends all the events to the virtual controller.
-        :param buffer: The main full/max buffer.
+        Tells that a batch was received, and when. This must be invoked
+        before processing its frames. Any batch keeps the pad alive.
+        :param stamp: The time.perf_counter_ns() value given by
+            tracing.sample(), or None if the batch is not traced.
+        """
+
+        self._last_seen = time.monotonic()
+        self._received_at = stamp
+
+    def _process_events(self, buffer: memoryview, packed: bool = False):
+        """
+        Sends all the events to the virtual controller. They are
+        normalized by the slot itself.
+        :param buffer: The (key, state) pairs of the frame, or the
+            packed whole state.
+        :param packed: Whether the buffer is a packed whole state.
         """
 
         if self._pad_index is None:
             return
 
-        # Only changed buttons and axes will exist here.
-        fixed = []
-        for index in range(0, len(buffer), 2):
-            key, state = buffer[index:index + 2]
-            if 0 <= key < 14:
-                # These are the buttons. State becomes boolean.
-                # Fix any change to {0 -> 0}|{1... -> 1}
-                fixed.append((key, state and 1))
+        # Send (or stage, when coalescing) the data. If the
+        # current pad is different, then this thread ends.
+        slots = self._slots
+        try:
+            if self._coalesce:
+                (slots.stage_packed if packed else slots.stage)(self._pad_index, buffer, self._connection_index)
+            elif self._received_at is not None:
+                parsed = time.perf_counter_ns()
+                (slots.emit_packed if packed else slots.emit)(self._pad_index, buffer, self._connection_index)
+                tracing.record(self._pad_index, self._received_at, parsed, time.perf_counter_ns())
             else:
-                # 0-255 state is respected for axes.
-                fixed.append((key, min(255, max(0, state))))
-        # Send the data. If the current pad is different,
-        # then this thread ends.
+                (slots.emit_packed if packed else slots.emit)(self._pad_index, buffer, self._connection_index)
+        except:
+            traceback.print_exc()
+
+    def flush(self):
+        """
+        Emits the frames staged while coalescing. This must be invoked
+        after processing all the frames received in a single read.
+        """
+
+        received_at, self._received_at = self._received_at, None
+        if not self._coalesce or self._pad_index is None:
+            return
+
         try:
-            self._slots.emit(self._pad_index, fixed, self.index)
+            if received_at is not None:
+                parsed = time.perf_counter_ns()
+                self._slots.commit(self._pad_index, self._connection_index)
+                tracing.record(self._pad_index, received_at, parsed, time.perf_counter_ns())
+            else:
+                self._slots.commit(self._pad_index, self._connection_index)
         except:
             traceback.print_exc()
 
+    def process(self, length: int, commands: memoryview) -> bool:
+        """
+        Processes a single received command.
+        :param length: The command's length byte.
+        :param commands: The command's payload (only meaningful
+            for button/axis commands, full states, and timed pings).
+        :return: Whether the connection must keep being attended.
+        """
+
+        FRAMES_RECEIVED.inc(self._pad_index)
+        if length < N_BUTTONS:
+            EVENTS_RECEIVED.inc(self._pad_index, amount=length)
+            self._process_events(commands)
+        elif length == FULL_STATE:
+            # Only pads that negotiated the protocol v2 send these.
+            if self._version == PROTOCOL_V2:
+                EVENTS_RECEIVED.inc(self._pad_index, amount=N_BUTTONS)
+                self._process_events(commands, True)
+        elif length == CLOSE_CONNECTION:
+            self._slots.release(self._pad_index, False, self._connection_index, True)
+            self._pad_index = None
+            return False
+        elif length == PING:
+            LOGGER.debug(f"Remote #{self._connection_index} ping")
+            self._cadence.observe(time.monotonic())
+            self._pinged = True
+            self._send(PONG)
+        elif length == TIMED_PING:
+            self._cadence.observe(time.monotonic())
+            self._pinged = True
+            self._timed_ping(commands)
+        elif length == UDP_OPEN:
+            self._open_udp()
+        return self._pad_index is not None
+
+    def _open_udp(self):
+        """
+        Opens a UDP session (or gives the one already open) and tells
+        its token to the pad.
+        """
+
+        if self._udp is None:
+            self._send(UDP_UNAVAILABLE)
+            return
+        if self._udp_token is None:
+            self._udp_token = self._udp.open(self.process_datagram)
+            LOGGER.info(f"Remote #{self._connection_index} opened a UDP session")
+        self._send(UDP_TOKEN + UDP_TOKEN_PAYLOAD.pack(self._udp_token, self._udp.port))
+
+    def process_datagram(self, frame: memoryview) -> bool:
+        """
+        Processes a frame received via UDP. It counts as liveness, as
+        the frames received via TCP do.
+        :param frame: The frame: a length byte and its (key, state) pairs,
+            or (for the protocol v2) a full state.
+        :return: Whether the frame was valid.
+        """
+
+        length = frame[0]
+        packed = length == FULL_STATE and self._version == PROTOCOL_V2
+        if packed:
+            valid = len(frame) == 1 + PACKED_STATE.size
+        else:
+            valid = length < N_BUTTONS and len(frame) == 1 + (length << 1)
+        if not valid:
+            UDP_DROPPED.inc("malformed")
+            return False
+
+        with self._lock:
+            if self._pad_index is None:
+                return False
+
+            self._last_seen = time.monotonic()
+            FRAMES_RECEIVED.inc(self._pad_index)
+            EVENTS_RECEIVED.inc(self._pad_index, amount=N_BUTTONS if packed else length)
+            self._received_at = tracing.sample()
+            self._process_events(frame[1:], packed)
+            self.flush()
+            return True
+
+    def _timed_ping(self, payload: memoryview):
+        """
+        Answers a timed ping and, when it echoes a previous timed pong,
+        takes a round trip sample from it.
+        :param payload: The client's send time, the echoed server send
+            time, and how long the client held that pong.
+        """
+
+        received = time.time_ns() // 1000
+        sent, echoed, held = TIMED_PING_PAYLOAD.unpack(payload)
+        if echoed:
+            rtt = (received - echoed - held) / 1e6
+            # The ping was sent half a round trip ago, by our clock.
+            offset = (sent - received) / 1e6 + rtt / 2
+            try:
+                self._slots.observe_round_trip(self._pad_index, rtt, offset, self._connection_index)
+            except PadMismatch:
+                pass
+            LOGGER.debug(f"Remote #{self._connection_index} timed ping: rtt={rtt:.6f}s, offset={offset:.6f}s")
+        self._send(TIMED_PONG + TIMED_PONG_PAYLOAD.pack(sent, received, time.time_ns() // 1000))
+
+    @property
+    def timeout(self) -> float:
+        """
+        How long the pad may stay silent before it is released.
+        """
+
+        round_trip = self._slots[self._pad_index].round_trip if self._pad_index is not None else RoundTrip()
+        return self._liveness.timeout(self._cadence, round_trip)
+
+    @property
+    def heartbeat_interval(self) -> float:
+        """
+        How long to wait before the next heartbeat check: until the
+        pad would time out, if nothing else is received. The timeout
+        is remembered, to tell when it drops (see timeout_dropped).
+        """
+
+        timeout = self._scheduled_timeout = self.timeout
+        self._pinged = False
+        return max(self._last_seen + timeout - time.monotonic(), _MIN_CHECK_DELAY)
+
+    def timeout_dropped(self) -> bool:
+        """
+        Tells whether the timeout dropped since the next heartbeat
+        check was scheduled (with the pings received since then), so
+        the check must be scheduled earlier. This must be invoked after
+        processing the frames received in a single read.
+        :return: Whether the heartbeat check must be rescheduled.
+        """
+
+        if not self._pinged:
+            return False
+        self._pinged = False
+        return self._scheduled_timeout is not None and self.timeout < self._scheduled_timeout
+
+    @property
+    def overdue(self) -> bool:
+        """
+        Whether the pad stayed silent for longer than its timeout.
+        """
+
+        return time.monotonic() - self._last_seen >= self.timeout
+
+    def heartbeat(self, notify: bool = True) -> bool:
+        """
+        Checks whether the pad sent anything in time. If it did not,
+        the pad is released and notified about the timeout.
+        :param notify: Whether to notify the pad right away. Otherwise,
+            the transport must do it later, via notify_timeout (e.g.
+            when writing may block the thread doing the check).
+        :return: Whether the heartbeat must keep running.
+        """
+
+        if self._pad_index not in SLOTS_INDICES or \
+                self._slots[self._pad_index].connection_index != self._connection_index:
+            return False
+
+        if not self.overdue:
+            return True
+
+        HEARTBEAT_TIMEOUTS.inc()
+        self._broadcast({"type": "notification", "command": "pad:timeout", "index": self._pad_index})
+        self._timeout_pending = True
+        if notify:
+            self.notify_timeout()
+        try:
+            self._slots.release(self._pad_index, False, self._connection_index, False, "timeout")
+        except PadNotInUse:
+            pass
+        self._pad_index = None
+        return False
+
+    def notify_timeout(self):
+        """
+        Tells the pad that it timed out, unless it was already told
+        (or it did not time out at all).
+        """
+
+        if self._timeout_pending:
+            self._timeout_pending = False
+            self._send(TIMEOUT)
+
+    def close(self):
+        """
+        Releases the pad, if still occupied by this connection, and
+        closes its UDP session.
+        """
+
+        if self._udp_token is not None:
+            self._udp.close(self._udp_token)
+            self._udp_token = None
+        try:
+            if self._pad_index is not None:
+                self._slots.release(self._pad_index, False, self._connection_index, False)
+        except PadNotInUse:
+            pass
+        self._pad_index = None
+
+
+class PadHandler(IndexedHandler):
+
+    def __init__(self, request: Any, client_address: Any, server: socketserver.BaseServer):
+        self._session = None
+        self._frames = None
+        self._heartbeat_timer = None
+        # Each scheduled heartbeat check has its own generation, so a
+        # check that was already due when it was rescheduled does nothing.
+        self._heartbeat_generation = 0
+        if not isinstance(server, PadServer):
+            raise ValueError("Only a MainServer (or subclasses) can use a PadHandler")
+        self._slots = server.slots
+        super().__init__(request, client_address, server)
+
+    @property
+    def slots(self):
+        return self._slots
+
+    def _schedule_heartbeat(self) -> None:
+        """
+        Schedules the next heartbeat check, replacing the pending one
+        (if any). The session's lock must be held.
+        """
+
+        if self._heartbeat_timer:
+            self._heartbeat_timer.cancel()
+        self._heartbeat_generation += 1
+        self._heartbeat_timer = self._slots.timers.schedule(self._session.heartbeat_interval, self._heartbeat,
+                                                            self._heartbeat_generation)
+
+    def _heartbeat(self, generation: int) -> None:
+        """
+        Heartbeat for the gamepad. It runs in the timers thread, which
+        is shared by all the pads, so it never writes to the socket: on
+        a timeout, the handler notifies the pad by itself.
+        :param generation: The generation of the check.
+        """
+
+        lock = self._session.lock
+        if not lock.acquire(blocking=False):
+            # The handler is processing this pad's data, or is blocked
+            # writing to it: never wait for it. If the pad is overdue
+            # anyway, it is not reading, so the socket is shut down to
+            # unblock the handler. Otherwise, check again later.
+            if self._session.overdue:
+                try:
+                    self.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            else:
+                self._slots.timers.schedule(_MIN_CHECK_DELAY, self._heartbeat, generation)
+            return
+        try:
+            if generation != self._heartbeat_generation:
+                return
+            keep = self._session.heartbeat(False)
+            if keep:
+                self._schedule_heartbeat()
+        finally:
+            lock.release()
+        if not keep:
+            # Unblock the handler, which is waiting for commands.
+            try:
+                self.request.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
     def setup(self) -> None:
         super().setup()
         LOGGER.info(f"Remote #{self.index} starting")
-        self._init_pad()
+        self._frames = FrameBuffer()
+        self._session = PadSession(self._slots, self.index, self.wfile.write, self.server.broadcast,
+                                   self.server.coalesce, self.server.liveness, self.server.udp)
+        if self._session.login(self._frames.receive(self.request, AUTH_SIZE) or b""):
+            with self._session.lock:
+                self._schedule_heartbeat()
 
     def handle(self) -> None:
         try:
-            while self._pad_index is not None:
+            while self._session.pad_index is not None:
                 try:
-                    buffer = self.rfile.read(1)
+                    received = self._frames.recv_into(self.request)
                 except ConnectionResetError:
                     # In this case, the socket died.
                     return
 
-                if not buffer:
-                    return
-
-                length = buffer[0]
-                if length < N_BUTTONS:
-                    commands = self.rfile.read(length * 2)
-                    if len(commands) != length * 2:
+                if not received:
+                    # A session that just ended had its reading shut down.
+                    if self._frames.pending and self._session.pad_index is not None:
                         self.wfile.write(COMMAND_LENGTH_MISMATCH)
-                        return
-                    self._process_events(commands)
-                elif length == CLOSE_CONNECTION:
-                    self.slots.release(self._pad_index, False, self.index, True)
-                    self._pad_index = None
                     return
-                elif length == PING:
-                    LOGGER.info(f"Remote #{self.index} ping")
-                    self._has_ping = True
-                    self.wfile.write(PONG)
-                    pass
+
+                with self._session.lock:
+                    self._session.received(tracing.sample())
+                    for length, commands in self._frames.frames():
+                        if not self._session.process(length, commands):
+                            return
+                    self._session.flush()
+                    if self._session.timeout_dropped():
+                        self._schedule_heartbeat()
         except PadMismatch:
             pass
         except Exception as e:
             traceback.print_exc()
             raise
         finally:
+            if self._heartbeat_timer:
+                self._heartbeat_timer.cancel()
             try:
-                if self._pad_index is not None:
-                    self.slots.release(self._pad_index, False, self.index, False)
-            except PadNotInUse:
+                self._session.notify_timeout()
+            except OSError:
                 pass
-            self._pad_index = None
+            with self._session.lock:
+                self._session.close()
 
     def finish(self) -> None:
         super().finish()
@@ -205,9 +584,12 @@ class PadServer(IndexedTCPServer):
     """
 
     def __init__(self, server_address: Tuple[str, int], RequestHandlerClass: Type[socketserver.BaseRequestHandler],
-                 bind_and_activate: bool, broadcast_server: IndexedTCPServer, slots: PadSlots):
+                 bind_and_activate: bool, broadcast_server: IndexedTCPServer, slots: PadSlots,
+                 coalesce: bool = False, liveness: Liveness = Liveness(), udp_port: int = 0):
         self._slots = slots
-        self._use_heartbeat_loop = False
+        self._coalesce = coalesce
+        self._liveness = liveness
+        self._udp = UdpChannel(udp_port) if udp_port else None
         self._broadcast_server = broadcast_server
         super().__init__(server_address, RequestHandlerClass, bind_and_activate)
 
@@ -215,28 +597,35 @@ class PadServer(IndexedTCPServer):
     def slots(self):
         return self._slots
 
-    def broadcast(self, message: bytes):
-        self._broadcast_server.broadcast(message)
+    @property
+    def coalesce(self):
+        return self._coalesce
+
+    @property
+    def liveness(self):
+        return self._liveness
+
+    @property
+    def udp(self):
+        return self._udp
 
-    def _heartbeat_loop(self):
-        while self._use_heartbeat_loop:
-            result = enumerate(self._slots.heartbeat())
-            for pad_index, device_disposed in result:
-                if device_disposed:
-                    LOGGER.info(f"Pad #{pad_index}'s device disposed on no use")
-            time.sleep(1)
+    def broadcast(self, message: dict):
+        self._broadcast_server.broadcast(message, PAD)
 
     def server_activate(self) -> None:
         super().server_activate()
-        self._use_heartbeat_loop = True
-        threading.Thread(target=self._heartbeat_loop).start()
+        if self._udp:
+            self._udp.start()
         LOGGER.info("Server started")
 
     def server_close(self) -> None:
+        if self._udp:
+            self._udp.stop()
         super().server_close()
-        self._use_heartbeat_loop = False
         LOGGER.info("Server stopped")
 
 
-def launch_pad_server(broadcast_server: BroadcastServer, slots: PadSlots) -> socketserver.TCPServer:
-    return launch_server_in_thread(PadServer, ("0.0.0.0", PAD_PORT), PadHandler, broadcast_server, slots)
+def launch_pad_server(broadcast_server: BroadcastServer, slots: PadSlots, coalesce: bool = False,
+                      liveness: Liveness = Liveness(), udp_port: int = 0) -> socketserver.TCPServer:
+    return launch_server_in_thread(PadServer, ("0.0.0.0", PAD_PORT), PadHandler, broadcast_server, slots, coalesce,
+                                   liveness, udp_port)
@@ -1,10 +1,41 @@
-import datetime
+import time
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
-from typing import List, Tuple
-from .constants import SLOTS_HEARTBEAT_TIME, SLOTS_INDICES
+from typing import List, Tuple, Union, Optional, Callable, Any
+from .constants import SLOTS_INDICES
 from .exceptions import PadInUse, PadNotInUse, PadIndexOutOfRange, AuthenticationFailed, PadMismatch
-from .devices import make, emit, emit_zero
+from .devices import make, emit, emit_zero, update, diff_packed, apply_packed, N_BUTTONS, N_KEYS, NORMALIZE, ZERO_STATE, \
+    BUTTON_KEYS, ABS_X, ABS_Y, BTN_UP, BTN_DOWN, BTN_LEFT, BTN_RIGHT
 from .settings import passwords_check
+from .retention import RetentionPolicy, LRU
+from .link import RoundTrip
+from ..timers import Timers
+from .. import metrics
+
+
+LOGGER = logging.getLogger("hawa.virtualpad.pads")
+LOGGER.setLevel(logging.INFO)
+
+
+Pairs = Union[bytes, bytearray, memoryview]
+# Listeners of the slots' changes get the pad index, the reason,
+# and the new serialized state of the pad.
+Listener = Callable[[int, str, Tuple[str, str]], Any]
+# The D-Pad directions are resolved together with their stick axis, so
+# when any of them changes, all of them present in the frame are kept.
+_X_GROUP = (1 << ABS_X) | (1 << BTN_LEFT) | (1 << BTN_RIGHT)
+_Y_GROUP = (1 << ABS_Y) | (1 << BTN_UP) | (1 << BTN_DOWN)
+_STICK_KEYS = (1 << ABS_X) | (1 << ABS_Y)
+# When frames are staged together, a D-Pad direction cannot be merged with
+# frames that already set the other direction or the stick axis: they would
+# be resolved as a single frame and not as the latest of them.
+_CONFLICTS = tuple(
+    {BTN_UP: _Y_GROUP, BTN_DOWN: _Y_GROUP, BTN_LEFT: _X_GROUP, BTN_RIGHT: _X_GROUP}.get(key, 0) & ~(1 << key)
+    for key in range(N_KEYS)
+)
 
 
 class PadSlot:
@@ -38,6 +69,40 @@ class PadSlot:
         self._connection_index = -1
         # And then, the stamp of last usage (main for status == RECENTLY_USED).
         self._last_user_stamp = None
+        # The last known state of the device, and how many of the
+        # received events were dropped for not changing it.
+        self._state = bytearray(ZERO_STATE)
+        # The pressed buttons of that state, as a bit mask, so packed
+        # states can be compared against it in a single operation.
+        self._buttons = 0
+        # The axes values last written to the device. The D-Pad is
+        # resolved into ABS_X / ABS_Y, so the stick values received
+        # are not always the ones on the device.
+        self._written = bytearray(ZERO_STATE)
+        # Increased on every change of the state, so readers can tell
+        # whether it changed without comparing it.
+        self._state_version = 0
+        self._received_events = 0
+        self._suppressed_events = 0
+        # The keys staged so far, and which of them changed.
+        self._staged_keys = 0
+        self._changed_keys = 0
+        self._staged_events = 0
+        # Devices may be created in the background, so their creation
+        # and disposal is guarded. Also, how long it takes since the pad
+        # is occupied until its first input is emitted.
+        self._device_lock = threading.Lock()
+        self._devices_ready = 0
+        self._devices_not_ready = 0
+        self._devices_created = 0
+        self._devices_destroyed = 0
+        # How long the device is kept when not in use, and since when it is not in use.
+        self._retention = RetentionPolicy()
+        self._device_stamp = None
+        self._occupied_stamp = None
+        self._first_input_time = None
+        # The timing of the occupant's connection.
+        self._round_trip = RoundTrip()
 
     @property
     def status(self) -> Status:
@@ -63,6 +128,129 @@ class PadSlot:
 
         return self._connection_index
 
+    @property
+    def received_events(self) -> int:
+        """
+        The amount of events received to be emitted.
+        """
+
+        return self._received_events
+
+    @property
+    def suppressed_events(self) -> int:
+        """
+        The amount of received events that were not emitted because
+        they did not change the state of the device.
+        """
+
+        return self._suppressed_events
+
+    @property
+    def has_device(self) -> bool:
+        """
+        Whether the device of this pad currently exists.
+        """
+
+        return self._device is not None
+
+    @property
+    def index(self) -> int:
+        """
+        The index of this pad.
+        """
+
+        return self._pad_index
+
+    @property
+    def device_stamp(self) -> Optional[float]:
+        """
+        When (by time.monotonic()) the device was last used or created.
+        """
+
+        return self._device_stamp
+
+    @property
+    def retention(self) -> RetentionPolicy:
+        """
+        How long the device is kept when not in use.
+        """
+
+        return self._retention
+
+    @retention.setter
+    def retention(self, value: RetentionPolicy):
+        self._retention = value
+
+    @property
+    def first_input_time(self) -> Optional[float]:
+        """
+        How long (in seconds) it took, for the last occupant, since
+        occupying the pad until its first input was emitted.
+        """
+
+        return self._first_input_time
+
+    @property
+    def round_trip(self) -> RoundTrip:
+        """
+        The round trip time of the occupant's connection.
+        """
+
+        return self._round_trip
+
+    @property
+    def state(self) -> Tuple[int, bytes]:
+        """
+        The last known state of the device (one byte per key, in the
+        order of the keys defined in the `devices` file) and its version.
+        """
+
+        version = self._state_version
+        return version, bytes(self._state)
+
+    def _reset_state(self):
+        self._state[:] = ZERO_STATE
+        self._buttons = 0
+        self._written[:] = ZERO_STATE
+        self._state_version += 1
+        self._clear_staged()
+
+    def _make_device(self) -> bool:
+        with self._device_lock:
+            if self._device is not None:
+                return False
+            self._device = make(self._name)
+            self._device_stamp = time.monotonic()
+            self._devices_created += 1
+            metrics.DEVICES_CREATED.inc(self._pad_index)
+            self._reset_state()
+            return True
+
+    def _drop_device(self):
+        with self._device_lock:
+            if self._device is not None:
+                self._devices_destroyed += 1
+                metrics.DEVICES_DESTROYED.inc(self._pad_index)
+            self._device = None  # It will be destroyed.
+            self._device_stamp = None
+            self._reset_state()
+
+    def prewarm(self) -> bool:
+        """
+        Creates the device in advance, so occupying the pad does not
+        have to wait for it.
+        :return: Whether the device was created.
+        """
+
+        if self._status == self.Status.OCCUPIED:
+            return False
+        return self._make_device()
+
+    def _clear_staged(self):
+        self._staged_keys = 0
+        self._changed_keys = 0
+        self._staged_events = 0
+
     def occupy(self, nickname: str, connection_index: int):
         """
         Occupies the pad by a user in a given connection index.
@@ -73,11 +261,16 @@ class PadSlot:
         if self._status == self.Status.OCCUPIED:
             raise PadInUse(self._pad_index)
 
+        self._occupied_stamp = time.perf_counter()
+        self._first_input_time = None
+        self._round_trip = RoundTrip()
         self._status = self.Status.OCCUPIED
         self._nickname = nickname
         self._connection_index = connection_index
-        if self._device is None:
-            self._device = make(self._name)
+        if self._make_device():
+            self._devices_not_ready += 1
+        else:
+            self._devices_ready += 1
 
     def release(self, force: bool = False, expect: int = -1,
                 zero: bool = False):
@@ -102,47 +295,192 @@ class PadSlot:
             self._last_user_stamp = None
             if zero and self._device:
                 emit_zero(self._device)
-            self._device = None  # It will be destroyed.
+            self._drop_device()
         else:
             if self._status != self.Status.OCCUPIED:
                 raise PadNotInUse(self._pad_index)
 
             if expect in [-1, self._connection_index]:
+                if self._staged_keys:
+                    # Keep the device consistent with its known state.
+                    self.commit()
                 self._status = self.Status.RECENTLY_USED
                 self._nickname = ""
                 self._connection_index = -1
-                self._last_user_stamp = datetime.datetime.now()
+                self._last_user_stamp = time.monotonic()
+                self._device_stamp = self._last_user_stamp
                 if zero:
                     # By this point, self._device will exist.
                     emit_zero(self._device)
+                    self._reset_state()
+
+    def stage(self, events: Pairs):
+        """
+        Stages the events of a frame, if this slot is occupied. Staged
+        frames are merged (the latest state of each key wins) and then
+        emitted together on commit. A frame that would hide a button's
+        press or release, or would change how the D-Pad is resolved,
+        commits the already staged frames first.
+        :param events: The events to stage, as (key, state) pairs flattened
+            in a bytes-like object. The valid keys are defined in the
+            `devices` file.
+        """
+
+        if self._status != self.Status.OCCUPIED:
+            raise PadNotInUse(self._pad_index)
+
+        state = self._state
+        staged = self._staged_keys
+        if staged:
+            for index in range(0, len(events), 2):
+                key = events[index]
+                if key < N_KEYS and (staged & _CONFLICTS[key] or (
+                        key < N_BUTTONS and staged >> key & 1 and state[key] != NORMALIZE[key][events[index + 1]])):
+                    self.commit()
+                    break
+
+        present, changed = update(state, events)
+        # Buttons are either 0 or 1, so the changed ones just flip.
+        self._buttons ^= changed & BUTTON_KEYS
+        # A received stick value is only the same when the device has it.
+        stick = present & _STICK_KEYS & ~changed
+        if stick:
+            written = self._written
+            if stick >> ABS_X & 1 and state[ABS_X] != written[ABS_X]:
+                changed |= 1 << ABS_X
+            if stick >> ABS_Y & 1 and state[ABS_Y] != written[ABS_Y]:
+                changed |= 1 << ABS_Y
+        self._staged_keys |= present
+        self._changed_keys |= changed
+        self._staged_events += len(events) >> 1
+        self._received_events += len(events) >> 1
+
+    def commit(self):
+        """
+        Emits the staged events, if this slot is occupied. The events
+        that do not change the last known state of the device are dropped.
+        """
+
+        if self._status != self.Status.OCCUPIED:
+            raise PadNotInUse(self._pad_index)
 
-    def emit(self, events: List[Tuple[int, int]]):
+        staged = self._staged_keys
+        changed = self._changed_keys
+        if changed & _X_GROUP:
+            changed |= staged & _X_GROUP
+        if changed & _Y_GROUP:
+            changed |= staged & _Y_GROUP
+
+        self._suppressed_events += self._staged_events - bin(changed).count("1")
+        self._clear_staged()
+        if changed:
+            self._state_version += 1
+            if metrics.enabled():
+                start = time.perf_counter()
+                emit(self._device, self._state, changed, self._written)
+                metrics.EMIT_SECONDS.observe(time.perf_counter() - start)
+            else:
+                emit(self._device, self._state, changed, self._written)
+            if self._first_input_time is None:
+                self._first_input_time = time.perf_counter() - self._occupied_stamp
+
+    def emit(self, events: Pairs):
+        """
+        Emits events, if this slot is occupied. The events that do
+        not change the last known state of the device are dropped.
+        :param events: The events to emit, as (key, state) pairs flattened
+            in a bytes-like object. The valid keys are defined in the
+            `devices` file.
+        """
+
+        self.stage(events)
+        self.commit()
+
+    def stage_packed(self, packed: Pairs):
         """
-        Emits events, if this slot is occupied.
-        :param events: The events to emit, as a list of (key, state) pairs.
-            The valid keys are defined in the `devices` file.
+        Stages a packed whole state, if this slot is occupied. Only the
+        keys that differ from the last known state are staged (so, as
+        in any other frame, the D-Pad drives its axes unless they change
+        as well).
+        :param packed: The packed state (see PACKED_STATE in the
+            `devices` file).
         """
 
         if self._status != self.Status.OCCUPIED:
             raise PadNotInUse(self._pad_index)
 
-        emit(self._device, events)
+        state = self._state
+        changed, mask = diff_packed(state, self._buttons, packed)
+        staged = self._staged_keys
+        if staged:
+            # Only the changed keys are taken as present, so the same
+            # conflicts as in the other frames apply: a staged button
+            # that changes again, or a D-Pad change against its axis.
+            conflict = changed & staged & BUTTON_KEYS
+            remaining = changed
+            while remaining and not conflict:
+                bit = remaining & -remaining
+                remaining ^= bit
+                conflict = staged & _CONFLICTS[bit.bit_length() - 1]
+            if conflict:
+                self.commit()
+
+        apply_packed(state, changed, mask, packed)
+        self._buttons = mask
+        self._staged_keys |= changed
+        self._changed_keys |= changed
+        self._staged_events += N_KEYS
+        self._received_events += N_KEYS
+
+    def emit_packed(self, packed: Pairs):
+        """
+        Emits a packed whole state, if this slot is occupied. Only the
+        keys that differ from the last known state are emitted.
+        :param packed: The packed state (see PACKED_STATE in the
+            `devices` file).
+        """
+
+        self.stage_packed(packed)
+        self.commit()
+
+    @property
+    def expires_at(self) -> Optional[float]:
+        """
+        When (by time.monotonic()) the pad will be completely released.
+        Only meaningful on RECENTLY_USED status.
+        """
+
+        if self._status != self.Status.RECENTLY_USED:
+            return None
+        return self._retention.expires_at(self._last_user_stamp)
 
     def heartbeat(self) -> bool:
         """
         Completely releases the pad, if it is recently used and
-        the heartbeat time has elapsed.
-        :returns: Whether the heartbeat was elapsed.
+        the retention time has elapsed.
+        :returns: Whether the retention time was elapsed.
         """
 
-        if self._status == self.Status.RECENTLY_USED and \
-                (datetime.datetime.now() - self._last_user_stamp).total_seconds() > SLOTS_HEARTBEAT_TIME:
-            self._status = self.Status.EMPTY
-            self._last_user_stamp = None
-            self._device = None  # It will be destroyed.
-            return True
+        expires_at = self.expires_at
+        if expires_at is not None and time.monotonic() >= expires_at:
+            return self.dispose()
         return False
 
+    def dispose(self) -> bool:
+        """
+        Completely releases the pad and drops its device, unless
+        the pad is occupied.
+        :returns: Whether the device was dropped.
+        """
+
+        if self._status == self.Status.OCCUPIED:
+            return False
+        had_device = self._device is not None
+        self._status = self.Status.EMPTY
+        self._last_user_stamp = None
+        self._drop_device()
+        return had_device
+
     def serialize(self) -> Tuple[str, str]:
         """
         Returns the current state of this pad, as (status, nick).
@@ -155,14 +493,85 @@ class PadSlot:
         else:
             return "empty", ""
 
+    def stats(self) -> dict:
+        """
+        Returns the emission counters of this pad.
+        """
+
+        return {
+            "received": self._received_events,
+            "suppressed": self._suppressed_events,
+            "devices_ready": self._devices_ready,
+            "devices_not_ready": self._devices_not_ready,
+            "devices_created": self._devices_created,
+            "devices_destroyed": self._devices_destroyed,
+            "first_input_time": self._first_input_time,
+        }
+
 
 class PadSlots:
     """
     A collection of instances, and means to manage them all indirectly.
     """
 
-    def __init__(self):
+    def __init__(self, timers: Timers, prewarm: int = 0):
+        """
+        :param timers: The timers used to expire the recently used pads.
+        :param prewarm: How many pads (the first ones) will have their
+            devices created in advance: on warm_up, and right after
+            they expire.
+        """
+
         self._slots = [PadSlot(index) for index in SLOTS_INDICES]
+        self._timers = timers
+        self._expirations = [None for _ in SLOTS_INDICES]
+        self._prewarm = max(0, min(len(self._slots), prewarm))
+        self._warmer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="virtualpad-warmer")
+        self._listeners: List[Listener] = []
+        self._versions = itertools.count(1)
+        self._version = 0
+
+    @property
+    def timers(self) -> Timers:
+        return self._timers
+
+    @property
+    def version(self) -> int:
+        """
+        Increased on every change of the pads' status (i.e. whenever
+        they are occupied, released, cleared, expired, or evicted).
+        """
+
+        return self._version
+
+    def add_listener(self, listener: Listener):
+        """
+        Adds a listener of the changes of the slots (occupied, released,
+        cleared, expired, or evicted). Listeners are invoked in the thread
+        that caused the change, so they must be short.
+        :param listener: The listener.
+        """
+
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener: Listener):
+        """
+        Removes a listener of the changes of the slots.
+        :param listener: The listener.
+        """
+
+        self._listeners = [item for item in self._listeners if item is not listener]
+
+    def _notify(self, pad_index: int, reason: str, before: Tuple[str, str]):
+        after = self._slots[pad_index].serialize()
+        if after == before:
+            return
+        self._version = next(self._versions)
+        for listener in self._listeners:
+            try:
+                listener(pad_index, reason, after)
+            except Exception:
+                LOGGER.exception("An error occurred in a slots listener!")
 
     def __getitem__(self, item) -> PadSlot:
         """
@@ -189,10 +598,13 @@ class PadSlots:
         if not passwords_check(pad_index, password):
             raise AuthenticationFailed()
 
+        before = pad.serialize()
         pad.occupy(nickname, connection_index)
+        self._notify(pad_index, "occupied", before)
+        self._evict()
 
     def release(self, pad_index: int, force: bool = False, expect: int = -1,
-                zero: bool = False):
+                zero: bool = False, reason: Optional[str] = None):
         """
         Releases a pad by its index.
         :param pad_index: The index of the pad to release.
@@ -203,6 +615,8 @@ class PadSlots:
             does not match the expected one (this is a silent
             failure and only when force == False).
         :param zero: Whether to emit the zero keys or not.
+        :param reason: The reason told to the listeners. By default,
+            it is "cleared" when forced, and "released" otherwise.
         """
 
         try:
@@ -210,7 +624,99 @@ class PadSlots:
         except IndexError:
             raise PadIndexOutOfRange(pad_index)
 
+        before = pad.serialize()
         pad.release(force, expect, zero)
+        self._notify(pad_index, reason or ("cleared" if force else "released"), before)
+        self._schedule_expiration(pad_index)
+
+    def _schedule_expiration(self, pad_index: int):
+        expiration = self._expirations[pad_index]
+        if expiration:
+            expiration.cancel()
+        expires_at = self._slots[pad_index].expires_at
+        if expires_at is None:
+            self._expirations[pad_index] = None
+        else:
+            self._expirations[pad_index] = self._timers.schedule_at(expires_at, self._expire, pad_index)
+
+    def _heartbeat(self, pad_index: int) -> bool:
+        pad = self._slots[pad_index]
+        before = pad.serialize()
+        if pad.heartbeat():
+            LOGGER.info(f"Pad #{pad_index}'s device disposed on no use")
+            self._notify(pad_index, "expired", before)
+            return True
+        return False
+
+    def _expire(self, pad_index: int):
+        self._expirations[pad_index] = None
+        if self._heartbeat(pad_index) and pad_index < self._prewarm:
+            self._warmer.submit(self._warm, pad_index)
+
+    def _warm(self, pad_index: int):
+        try:
+            if self._slots[pad_index].prewarm():
+                LOGGER.info(f"Pad #{pad_index}'s device created in advance")
+                self._evict()
+        except Exception:
+            LOGGER.exception(f"Pad #{pad_index}'s device could not be created in advance")
+
+    def _evict(self):
+        """
+        Drops the least recently used devices of the pads with an LRU
+        retention, while there are more devices than allowed.
+        """
+
+        count = sum(1 for pad in self._slots if pad.has_device)
+        candidates = sorted(
+            (pad for pad in self._slots
+             if pad.retention.mode == LRU and pad.has_device and pad.status != PadSlot.Status.OCCUPIED),
+            key=lambda pad: pad.device_stamp
+        )
+        for pad in candidates:
+            if count <= pad.retention.max_devices:
+                continue
+            before = pad.serialize()
+            if pad.dispose():
+                LOGGER.info(f"Pad #{pad.index}'s device disposed as least recently used")
+                self._notify(pad.index, "evicted", before)
+                count -= 1
+
+    def retention(self) -> List[dict]:
+        """
+        Gets the retention policies of all the pads.
+        :return: The list of policies, per pad.
+        """
+
+        return [pad.retention.serialize() for pad in self._slots]
+
+    def set_retention(self, policy: RetentionPolicy, *indices: int):
+        """
+        Sets the retention policy of the given pads, and applies it
+        to the devices not in use right away.
+        :param policy: The policy to set.
+        :param indices: The pads to set the policy to. If empty,
+            the policy is set to all the pads.
+        """
+
+        indices = indices or SLOTS_INDICES
+        for pad_index in indices:
+            if pad_index not in SLOTS_INDICES:
+                raise PadIndexOutOfRange(pad_index)
+        for pad_index in indices:
+            self._slots[pad_index].retention = policy
+            self._schedule_expiration(pad_index)
+        for pad_index in SLOTS_INDICES:
+            self._heartbeat(pad_index)
+        self._evict()
+
+    def warm_up(self):
+        """
+        Creates, in background, the devices of the pads to prewarm.
+        """
+
+        for pad_index in range(self._prewarm):
+            self._warmer.submit(self._warm, pad_index)
 
     def release_all(self):
         """
@@ -220,25 +726,101 @@ class PadSlots:
         for index in SLOTS_INDICES:
             self.release(index, force=True, zero=True)
 
-    def emit(self, pad_index: int, events: List[Tuple[int, int]], expect: int = -1):
+    def _occupied(self, pad_index: int, expect: int) -> PadSlot:
+        try:
+            pad = self._slots[pad_index]
+        except IndexError:
+            raise PadIndexOutOfRange(pad_index)
+
+        if expect not in [-1, pad.connection_index]:
+            raise PadMismatch(pad_index)
+
+        return pad
+
+    def emit(self, pad_index: int, events: Pairs, expect: int = -1):
         """
         Emits events, if the slot is occupied.
         :param pad_index: The index of the pad that will emit the events.
-        :param events: The events to emit, as a list of (key, state) pairs.
-            The valid keys are defined in the `devices` file.
+        :param events: The events to emit, as (key, state) pairs flattened
+            in a bytes-like object. The valid keys are defined in the
+            `devices` file.
         :param expect: The connection index to expect. A mismatch between
             this value (if != -1) and the current connection is an error.
         """
 
-        try:
-            pad = self._slots[pad_index]
-        except IndexError:
-            raise PadIndexOutOfRange(pad_index)
+        self._occupied(pad_index, expect).emit(events)
 
-        if expect not in [-1, pad.connection_index]:
-            raise PadMismatch(pad_index)
+    def stage(self, pad_index: int, events: Pairs, expect: int = -1):
+        """
+        Stages events, if the slot is occupied. They will be emitted on commit.
+        :param pad_index: The index of the pad that will stage the events.
+        :param events: The events to stage, as (key, state) pairs flattened
+            in a bytes-like object. The valid keys are defined in the
+            `devices` file.
+        :param expect: The connection index to expect. A mismatch between
+            this value (if != -1) and the current connection is an error.
+        """
+
+        self._occupied(pad_index, expect).stage(events)
+
+    def emit_packed(self, pad_index: int, packed: Pairs, expect: int = -1):
+        """
+        Emits a packed whole state, if the slot is occupied.
+        :param pad_index: The index of the pad that will emit the state.
+        :param packed: The packed state (see PACKED_STATE in the
+            `devices` file).
+        :param expect: The connection index to expect. A mismatch between
+            this value (if != -1) and the current connection is an error.
+        """
+
+        self._occupied(pad_index, expect).emit_packed(packed)
+
+    def stage_packed(self, pad_index: int, packed: Pairs, expect: int = -1):
+        """
+        Stages a packed whole state, if the slot is occupied. It will
+        be emitted on commit.
+        :param pad_index: The index of the pad that will stage the state.
+        :param packed: The packed state (see PACKED_STATE in the
+            `devices` file).
+        :param expect: The connection index to expect. A mismatch between
+            this value (if != -1) and the current connection is an error.
+        """
+
+        self._occupied(pad_index, expect).stage_packed(packed)
+
+    def commit(self, pad_index: int, expect: int = -1):
+        """
+        Emits the staged events, if the slot is occupied.
+        :param pad_index: The index of the pad that will emit the events.
+        :param expect: The connection index to expect. A mismatch between
+            this value (if != -1) and the current connection is an error.
+        """
+
+        self._occupied(pad_index, expect).commit()
+
+    def observe_round_trip(self, pad_index: int, rtt: float, offset: Optional[float] = None,
+                           expect: int = -1) -> bool:
+        """
+        Adds a round trip sample of the occupant's connection.
+        :param pad_index: The index of the pad.
+        :param rtt: The measured round trip time, in seconds.
+        :param offset: The measured clock offset, in seconds, if any.
+        :param expect: The connection index to expect. A mismatch between
+            this value (if != -1) and the current connection is an error.
+        :return: Whether the sample was taken.
+        """
+
+        return self._occupied(pad_index, expect).round_trip.observe(rtt, offset)
+
+    def round_trips(self) -> List[Optional[dict]]:
+        """
+        Gets the round trip estimates of the occupied pads' connections.
+        :return: The list of estimates (None when not occupied, or not
+            measured yet), per pad.
+        """
 
-        pad.emit(events)
+        return [pad.round_trip.serialize() if pad.status == PadSlot.Status.OCCUPIED else None
+                for pad in self._slots]
 
     def heartbeat(self) -> List[bool]:
         """
@@ -246,7 +828,7 @@ class PadSlots:
         :return: The heartbeat results.
         """
 
-        return [pad.heartbeat() for pad in self._slots]
+        return [self._heartbeat(pad_index) for pad_index in SLOTS_INDICES]
 
     def serialize(self) -> List[Tuple[str, str]]:
         """
@@ -255,3 +837,11 @@ class PadSlots:
         """
 
         return [pad.serialize() for pad in self._slots]
+
+    def stats(self) -> List[dict]:
+        """
+        Gets all the pads' emission counters.
+        :return: The list of counters, per pad.
+        """
+
+        return [pad.stats() for pad in self._slots]
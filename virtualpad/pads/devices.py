@@ -1,4 +1,7 @@
-from typing import List, Tuple
+import os
+import struct
+import threading
+from typing import Tuple, NamedTuple, Union, Optional
 import uinput
 import traceback
 
@@ -27,7 +30,86 @@ ABS_RY = 17
 N_AXES = 4
 
 
-def make(name: str):
+N_KEYS = N_BUTTONS + N_AXES
+ALL_KEYS = (1 << N_KEYS) - 1
+BUTTON_KEYS = (1 << N_BUTTONS) - 1
+AXES_KEYS = ALL_KEYS & ~BUTTON_KEYS
+# The state of a just created (or zeroed) device: released buttons and centered axes.
+ZERO_STATE = bytes([0] * N_BUTTONS + [127] * N_AXES)
+# The whole state of a pad, packed: the bit mask of the pressed buttons
+# (bit n is the button n), and then the 4 axes.
+PACKED_STATE = struct.Struct("!H4B")
+
+
+# struct input_event is: struct timeval (seconds, microseconds), type, code, value.
+# The kernel stamps the events written to uinput, so the time is left as zero.
+INPUT_EVENT = struct.Struct("llHHi")
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+EV_MSC = 0x04
+SYN_REPORT = 0x00
+MSC_SCAN = 0x04
+# Each frame is at most: a SCAN and a KEY per button, the 4 axes and the SYN.
+MAX_FRAME_SIZE = INPUT_EVENT.size * (2 * 10 + N_AXES + 1)
+
+
+# How each key is normalized: a table from the received state to the
+# stored one. Buttons become 0|1, and axes keep their 0 .. 255 value.
+_BUTTON_VALUES = bytes([0] + [1] * 255)
+_AXIS_VALUES = bytes(range(256))
+NORMALIZE = (_BUTTON_VALUES,) * N_BUTTONS + (_AXIS_VALUES,) * N_AXES
+
+# How each key is encoded. Buttons are sent as a SCAN and a KEY event.
+# D-Pad directions are not sent by themselves, but resolved into the
+# ABS_X / ABS_Y axes (unless those axes are explicitly sent in the same
+# frame): a pressed direction pulls its axis to one end, pulling to both
+# ends centers it, and pulling to none gives the axis back to the stick
+# (its last received value). Axes are sent as ABS events.
+_BUTTON = 0
+_DPAD = 1
+_AXIS = 2
+_X_LOW = 1
+_X_HIGH = 2
+_Y_LOW = 4
+_Y_HIGH = 8
+_DISPATCH = tuple(
+    # The records of a button are fully known in advance, per state.
+    (_BUTTON, tuple(
+        INPUT_EVENT.pack(0, 0, EV_MSC, MSC_SCAN, 0x90001 + key) + INPUT_EVENT.pack(0, 0, EV_KEY, 0x120 + key, value)
+        for value in (0, 1)
+    )) for key in range(10)
+) + (
+    (_DPAD, _Y_LOW),
+    (_DPAD, _Y_HIGH),
+    (_DPAD, _X_LOW),
+    (_DPAD, _X_HIGH),
+) + tuple(
+    (_AXIS, code) for _, code in (uinput.ABS_X, uinput.ABS_Y, uinput.ABS_RX, uinput.ABS_RY)
+)
+_X_DPAD = (1 << BTN_LEFT) | (1 << BTN_RIGHT)
+_Y_DPAD = (1 << BTN_UP) | (1 << BTN_DOWN)
+# The resulting axis value, by the pulled ends (low | high). When no end
+# is pulled, the stick's value is used instead.
+_RESOLVE = (None, 0, 255, 127)
+
+
+class PadDevice(NamedTuple):
+    """
+    A created pad device. The file descriptor is kept so whole frames
+    can be written to it at once, from its own preallocated buffer.
+    The device may be written from several threads (the pad's handler,
+    the admin's commands, the timers, the UDP channel), so the buffer
+    is only used while holding the lock.
+    """
+
+    device: uinput.Device
+    fd: int
+    buffer: bytearray
+    lock: threading.Lock
+
+
+def make(name: str) -> PadDevice:
     """
     Builds a pad device.
     :param name: The name to use.
@@ -43,20 +125,19 @@ def make(name: str):
     events = tuple(
         (0x01, k) for k in range(0x120, 0x12a)
     ) + axes + ((0x04, 0x04),)
+    fd = uinput.fdopen()
     device = uinput.Device(
         # bustype=virtual
         # vendor=0x2357 (I deliberately picked this one)
         # product_id=0x1
-        events, name=name, bustype=0x06, vendor=0x2357, product=0x1, version=1
+        events, name=name, bustype=0x06, vendor=0x2357, product=0x1, version=1, fd=fd
     )
-    device.emit(uinput.ABS_X, 127, syn=False)
-    device.emit(uinput.ABS_Y, 127, syn=False)
-    device.emit(uinput.ABS_RX, 127, syn=False)
-    device.emit(uinput.ABS_RY, 127, syn=True)
-    return device
+    pad_device = PadDevice(device, fd, bytearray(MAX_FRAME_SIZE), threading.Lock())
+    emit(pad_device, ZERO_STATE, AXES_KEYS)
+    return pad_device
 
 
-def emit_zero(device: uinput.Device):
+def emit_zero(device: PadDevice):
     """
     Emits a release of all the input keys. This is used when doing
     a pad release in the following conditions:
@@ -66,72 +147,145 @@ def emit_zero(device: uinput.Device):
     :param device: The device to emit the release of all the keys.
     """
 
-    emit(device, [(index, 0) for index in range(N_BUTTONS)] +
-                 [(index, 127) for index in range(N_BUTTONS, N_BUTTONS + N_AXES)])
+    emit(device, ZERO_STATE, ALL_KEYS)
+
+
+def update(state: bytearray, pairs: Union[bytes, bytearray, memoryview]) -> Tuple[int, int]:
+    """
+    Normalizes received events and stores them into a state.
+    :param state: The state to update.
+    :param pairs: The events, as (key, state) pairs flattened in
+        a bytes-like object. Invalid keys are ignored.
+    :return: The (present, changed) bit masks of the keys.
+    """
+
+    normalize = NORMALIZE
+    present = 0
+    changed = 0
+    for index in range(0, len(pairs), 2):
+        key = pairs[index]
+        if key >= N_KEYS:
+            continue
+        value = normalize[key][pairs[index + 1]]
+        bit = 1 << key
+        present |= bit
+        if state[key] != value:
+            state[key] = value
+            changed |= bit
+    return present, changed
 
 
-def emit(device: uinput.Device, events: List[Tuple[int, int]]):
+def diff_packed(state: Union[bytes, bytearray], buttons: int,
+                packed: Union[bytes, bytearray, memoryview]) -> Tuple[int, int]:
     """
-    Sends all the events to the device, atomically.
+    Compares a packed whole state against a known one.
+    :param state: The known state.
+    :param buttons: The bit mask of the pressed buttons in the known
+        state (bit n is the button n).
+    :param packed: The packed state: the bit mask of the pressed
+        buttons, and the 4 axes (see PACKED_STATE).
+    :return: The bit mask of the keys that changed, and the one of
+        the pressed buttons in the packed state.
+    """
+
+    mask, x, y, rx, ry = PACKED_STATE.unpack_from(packed)
+    mask &= BUTTON_KEYS
+    changed = mask ^ buttons
+    if state[ABS_X] != x:
+        changed |= 1 << ABS_X
+    if state[ABS_Y] != y:
+        changed |= 1 << ABS_Y
+    if state[ABS_RX] != rx:
+        changed |= 1 << ABS_RX
+    if state[ABS_RY] != ry:
+        changed |= 1 << ABS_RY
+    return changed, mask
+
+
+def apply_packed(state: bytearray, changed: int, mask: int, packed: Union[bytes, bytearray, memoryview]):
+    """
+    Stores the changed keys of a packed whole state into a state.
+    :param state: The state to update.
+    :param changed: The bit mask of the changed keys (see diff_packed).
+    :param mask: The bit mask of the pressed buttons (see diff_packed).
+    :param packed: The packed state.
+    """
+
+    remaining = changed & BUTTON_KEYS
+    while remaining:
+        bit = remaining & -remaining
+        remaining ^= bit
+        state[bit.bit_length() - 1] = 1 if mask & bit else 0
+    # The axes are stored as they are, after the buttons' mask.
+    state[N_BUTTONS:] = packed[2:2 + N_AXES]
+
+
+def encode(state: Union[bytes, bytearray], keys: int, buffer: bytearray,
+           written: Optional[bytearray] = None) -> int:
+    """
+    Encodes some keys of a state as the input_event records to write
+    to the device, including the final SYN_REPORT. This does not touch
+    the device at all.
+    :param state: The state to take the values from.
+    :param keys: The bit mask of the keys to encode.
+    :param buffer: The buffer to encode the records into.
+    :param written: If given, the encoded axes values are stored in it
+        (by key). They differ from the state's ones when the D-Pad is
+        resolved into the ABS_X / ABS_Y axes.
+    :return: The size of the encoded records.
+    """
+
+    pack_into = INPUT_EVENT.pack_into
+    size = INPUT_EVENT.size
+    dispatch = _DISPATCH
+    offset = 0
+    pulled = 0
+    remaining = keys
+    while remaining:
+        bit = remaining & -remaining
+        remaining ^= bit
+        key = bit.bit_length() - 1
+        kind, template = dispatch[key]
+        if kind == _BUTTON:
+            buffer[offset:offset + 2 * size] = template[state[key]]
+            offset += 2 * size
+        elif kind == _DPAD:
+            if state[key]:
+                pulled |= template
+        else:
+            pack_into(buffer, offset, 0, 0, EV_ABS, template, state[key])
+            offset += size
+            if written is not None:
+                written[key] = state[key]
+    if keys & _X_DPAD and not keys >> ABS_X & 1:
+        value = _RESOLVE[pulled & 3] if pulled & 3 else state[ABS_X]
+        pack_into(buffer, offset, 0, 0, EV_ABS, uinput.ABS_X[1], value)
+        offset += size
+        if written is not None:
+            written[ABS_X] = value
+    if keys & _Y_DPAD and not keys >> ABS_Y & 1:
+        value = _RESOLVE[pulled >> 2] if pulled >> 2 else state[ABS_Y]
+        pack_into(buffer, offset, 0, 0, EV_ABS, uinput.ABS_Y[1], value)
+        offset += size
+        if written is not None:
+            written[ABS_Y] = value
+    pack_into(buffer, offset, 0, 0, EV_SYN, SYN_REPORT, 0)
+    return offset + size
+
+
+def emit(device: PadDevice, state: Union[bytes, bytearray], keys: int, written: Optional[bytearray] = None):
+    """
+    Sends some keys of a state to the device, atomically: the
+    whole frame is written at once.
     :param device: The device to send the events to.
-    :param events: The events to send.
+    :param state: The state to take the values from.
+    :param keys: The bit mask of the keys to send.
+    :param written: If given, the sent axes values are stored in it (see encode).
     """
 
     try:
-        mapped_axes = [
-            uinput.ABS_X,
-            uinput.ABS_Y,
-            uinput.ABS_RX,
-            uinput.ABS_RY
-        ]
-
-        # Whether the ABS_X or ABS_Y axes (respectively) were
-        # explicitly sent or not.
-        abs_x_forced = False
-        abs_y_forced = False
-        # Changes to the axes (only apply while the _forced are
-        # not set).
-        abs_x_changes = None
-        abs_y_changes = None
-
-        for event, value in events:
-            if event < 10:
-                # Sending the button as-is, but also with a SCAN event.
-                _emit(device, (0x04, 0x04), 0x90001 + event)
-                _emit(device, (0x01, 0x120 + event), 1 if value else 0)
-            elif event < 14:
-                # Adding an axis change in the proper direction.
-                if event == BTN_UP:
-                    abs_y_changes = (abs_y_changes or set()) | {[127, 0][value]}
-                elif event == BTN_DOWN:
-                    abs_y_changes = (abs_y_changes or set()) | {[127, 255][value]}
-                elif event == BTN_LEFT:
-                    abs_x_changes = (abs_x_changes or set()) | {[127, 0][value]}
-                elif event == BTN_RIGHT:
-                    abs_x_changes = (abs_x_changes or set()) | {[127, 255][value]}
-            else:
-                # If ABS_X or ABS_Y is pressed, it will force whatever the D-Pad
-                # expresses in its 2 (corresponding) directions.
-                if event == ABS_X:
-                    abs_x_forced = True
-                if event == ABS_Y:
-                    abs_y_forced = True
-                _emit(device, mapped_axes[event - 14], int(min(255, max(0, value))))
-        # Check whether ABS_X was not forced and there are
-        # D-Pad changes in the X axis. If there are, force
-        # either the middle or the only specified direction
-        # set in the axis.
-        if not abs_x_forced and abs_x_changes is not None:
-            abs_x_changes -= {127}
-            _emit(device, uinput.ABS_X, abs_x_changes.pop() if len(abs_x_changes) == 1 else 127)
-        # The same, but the axis Y.
-        if not abs_y_forced and abs_y_changes is not None:
-            abs_y_changes -= {127}
-            _emit(device, uinput.ABS_Y, abs_y_changes.pop() if len(abs_y_changes) == 1 else 127)
-        device.syn()
+        buffer = device.buffer
+        with device.lock:
+            os.write(device.fd, memoryview(buffer)[:encode(state, keys, buffer, written)])
     except Exception as e:
         traceback.print_exc()
-
-
-def _emit(device, key, value):
-    device.emit(key, value, syn=False)
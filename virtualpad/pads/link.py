@@ -0,0 +1,143 @@
+from typing import Optional
+
+
+# The smoothing gains of the round trip time and its variation (as in
+# TCP's retransmission timer, RFC 6298).
+_ALPHA = 1 / 8
+_BETA = 1 / 4
+# Samples above this many seconds are taken as clock jumps, and ignored.
+_MAX_SAMPLE = 60.0
+
+
+class RoundTrip:
+    """
+    The smoothed round trip time of a pad's connection, its variation
+    (the jitter), and the estimated offset of the pad's clock against
+    the server's one. They are updated on each timed ping.
+    """
+
+    def __init__(self):
+        self._samples = 0
+        self._rtt = None
+        self._jitter = None
+        self._offset = None
+
+    @property
+    def samples(self) -> int:
+        """
+        How many samples were taken.
+        """
+
+        return self._samples
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """
+        The smoothed round trip time, in seconds, if known.
+        """
+
+        return self._rtt
+
+    @property
+    def jitter(self) -> Optional[float]:
+        """
+        The smoothed variation of the round trip time, in seconds, if known.
+        """
+
+        return self._jitter
+
+    @property
+    def offset(self) -> Optional[float]:
+        """
+        How much the pad's clock is ahead of the server's one, in
+        seconds, as of the last sample (if any).
+        """
+
+        return self._offset
+
+    def grace(self) -> float:
+        """
+        How long a reply may take beyond the expected time before it
+        is considered late: the smoothed round trip time plus four
+        times its variation (0 when nothing was measured yet).
+        """
+
+        if self._rtt is None:
+            return 0.0
+        return self._rtt + 4 * self._jitter
+
+    def observe(self, rtt: float, offset: Optional[float] = None) -> bool:
+        """
+        Adds a sample.
+        :param rtt: The measured round trip time, in seconds.
+        :param offset: The measured clock offset, in seconds, if any.
+        :return: Whether the sample was taken (invalid ones are ignored).
+        """
+
+        if not 0 <= rtt <= _MAX_SAMPLE:
+            return False
+        if self._rtt is None:
+            self._rtt = rtt
+            self._jitter = rtt / 2
+        else:
+            self._jitter += _BETA * (abs(self._rtt - rtt) - self._jitter)
+            self._rtt += _ALPHA * (rtt - self._rtt)
+        if offset is not None:
+            self._offset = offset
+        self._samples += 1
+        return True
+
+    def serialize(self) -> Optional[dict]:
+        """
+        Returns the current estimates, as a dictionary, or None if
+        nothing was measured yet.
+        """
+
+        if self._rtt is None:
+            return None
+        return {"rtt": self._rtt, "jitter": self._jitter, "offset": self._offset, "samples": self._samples}
+
+
+class Cadence:
+    """
+    The smoothed interval between a connection's pings, and its
+    variation. It tells how long the connection may stay silent.
+    """
+
+    def __init__(self):
+        self._last = None
+        self._interval = None
+        self._deviation = None
+
+    @property
+    def interval(self) -> Optional[float]:
+        """
+        The smoothed interval between pings, in seconds, if known.
+        """
+
+        return self._interval
+
+    @property
+    def deviation(self) -> Optional[float]:
+        """
+        The smoothed variation of the interval, in seconds, if known.
+        """
+
+        return self._deviation
+
+    def observe(self, stamp: float):
+        """
+        Tells that a ping was received.
+        :param stamp: When it was received (by time.monotonic()).
+        """
+
+        last, self._last = self._last, stamp
+        if last is None:
+            return
+        interval = stamp - last
+        if self._interval is None:
+            self._interval = interval
+            self._deviation = interval / 2
+        else:
+            self._deviation += _BETA * (abs(self._interval - interval) - self._deviation)
+            self._interval += _ALPHA * (interval - self._interval)
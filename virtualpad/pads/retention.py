@@ -0,0 +1,62 @@
+from typing import NamedTuple, Optional
+from .constants import SLOTS_HEARTBEAT_TIME, SLOTS_COUNT
+
+
+# Keep the device of a pad not in use forever.
+FOREVER = "forever"
+# Keep the device of a pad not in use for some seconds.
+TIMEOUT = "timeout"
+# Keep the devices of the pads not in use while the total amount of
+# devices does not exceed a maximum. Then, the least recently used
+# ones are disposed first.
+LRU = "lru"
+MODES = (FOREVER, TIMEOUT, LRU)
+
+
+class RetentionPolicy(NamedTuple):
+    """
+    Tells how long the device of a pad is kept after the pad stops
+    being used. Devices created in advance are not expired by time
+    (they are there to be used), but they do count, and may be
+    evicted, under the LRU mode.
+    """
+
+    mode: str = TIMEOUT
+    seconds: float = SLOTS_HEARTBEAT_TIME
+    max_devices: int = SLOTS_COUNT
+
+    def expires_at(self, stamp: float) -> Optional[float]:
+        """
+        Tells when a device not in use expires.
+        :param stamp: When the device stopped being used.
+        :return: When it expires, or None if it does not expire by time.
+        """
+
+        return stamp + self.seconds if self.mode == TIMEOUT else None
+
+    def serialize(self) -> dict:
+        """
+        Returns this policy, as a dictionary.
+        """
+
+        return self._asdict()
+
+    @classmethod
+    def parse(cls, data: dict) -> 'RetentionPolicy':
+        """
+        Parses a policy from a dictionary.
+        :param data: The dictionary, with the mode and, optionally,
+            the seconds and the max_devices.
+        :return: The policy.
+        """
+
+        mode = data.get("mode")
+        if mode not in MODES:
+            raise ValueError(f"Invalid retention mode: {mode}")
+        seconds = data.get("seconds", SLOTS_HEARTBEAT_TIME)
+        if not isinstance(seconds, (int, float)) or seconds < 0:
+            raise ValueError(f"Invalid retention seconds: {seconds}")
+        max_devices = data.get("max_devices", SLOTS_COUNT)
+        if not isinstance(max_devices, int) or max_devices < 0:
+            raise ValueError(f"Invalid retention max devices: {max_devices}")
+        return cls(mode, seconds, max_devices)
@@ -1,11 +1,127 @@
 import os
+import copy
 import json
 import random
+import struct
+import ctypes
+import ctypes.util
+import threading
+from typing import Optional
 from .constants import SLOTS_INDICES
 
 
 SETTINGS_PATH = "/etc/Hawa/virtualpad-server.conf"
 
+# inotify(7) support: struct inotify_event is wd, mask, cookie, len and then the name.
+_INOTIFY_EVENT = struct.Struct("iIII")
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_IGNORED = 0x00008000
+_IN_Q_OVERFLOW = 0x00004000
+_IN_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+
+def _inotify_watch(directory: str) -> Optional[int]:
+    """
+    Watches the changes of a directory's entries.
+    :param directory: The directory to watch.
+    :return: The non-blocking inotify descriptor, or None if inotify
+        is not available.
+    """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), _IN_WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class SettingsStore:
+    """
+    Keeps the parsed settings in memory, so they are only read again
+    from disk when the settings file changes. Changes are detected via
+    inotify or, if not available, by checking the file's stat.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._settings = None
+        self._inotify = None
+        self._stat = None
+
+    def _stat_key(self):
+        try:
+            stat = os.stat(SETTINGS_PATH)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except OSError:
+            return None
+
+    def _changed(self) -> bool:
+        if self._inotify is None:
+            return self._stat_key() != self._stat
+
+        try:
+            data = os.read(self._inotify, 4096)
+        except BlockingIOError:
+            return False
+
+        name = os.fsencode(os.path.basename(SETTINGS_PATH))
+        changed = False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            if mask & (_IN_IGNORED | _IN_Q_OVERFLOW):
+                # The directory is gone, or events were lost: watch again.
+                os.close(self._inotify)
+                self._inotify = None
+                return True
+            changed = changed or data[offset:offset + length].rstrip(b"\0") == name
+            offset += length
+        return changed
+
+    def _watch(self):
+        if self._inotify is None:
+            self._inotify = _inotify_watch(os.path.dirname(SETTINGS_PATH))
+        self._stat = self._stat_key()
+
+    def get(self) -> dict:
+        """
+        Gets the current settings (they must not be modified).
+        :return: The settings.
+        """
+
+        with self._lock:
+            if self._settings is None or self._changed():
+                # Start watching before reading, so no change is missed.
+                self._watch()
+                self._settings = load()
+            return self._settings
+
+    def put(self, settings: dict):
+        """
+        Sets the current settings, after they were saved.
+        :param settings: The saved settings.
+        """
+
+        with self._lock:
+            # The pending changes are the ones just saved.
+            self._changed()
+            self._watch()
+            self._settings = settings
+
+
+_STORE = SettingsStore()
+
 
 def _regenerate_password():
     return ''.join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(4))
@@ -36,7 +152,8 @@ def save(settings: dict):
 
     os.makedirs(os.path.dirname(SETTINGS_PATH), 0o700, exist_ok=True)
     with open(SETTINGS_PATH, 'w') as f:
-        return json.dump(settings, f)
+        json.dump(settings, f)
+    _STORE.put(settings)
 
 
 def passwords_check(index: int, password: str):
@@ -47,7 +164,7 @@ def passwords_check(index: int, password: str):
     :return: Whether the index is valid and the password matches.
     """
 
-    return index in SLOTS_INDICES and load()["passwords"][index] == password
+    return index in SLOTS_INDICES and _STORE.get()["passwords"][index] == password
 
 
 def passwords_regenerate(*args):
@@ -59,7 +176,7 @@ def passwords_regenerate(*args):
 
     if not args:
         args = tuple(range(8))
-    settings = load()
+    settings = copy.deepcopy(_STORE.get())
     for index in args:
         if index not in SLOTS_INDICES:
             continue
@@ -73,4 +190,4 @@ def passwords_get():
     :return: All the passwords.
     """
 
-    return load()["passwords"]
+    return list(_STORE.get()["passwords"])
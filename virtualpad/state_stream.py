@@ -0,0 +1,112 @@
+import threading
+import time
+from typing import Any, Callable, List, Optional
+from .pads import PadSlots, PadSlot
+from .pads.constants import SLOTS_COUNT
+from .timers import Timers, Timer
+
+
+# How many times per second the pads' states are published, by default.
+STATE_RATE = 30
+# How often the state of all the occupied pads is published, even
+# if it did not change, so new subscribers catch up.
+_KEYFRAME_INTERVAL = 1.0
+
+
+class PadStateStream:
+    """
+    Publishes the input state of the pads at a limited rate, so
+    overlays can show what each player is pressing. On each tick,
+    only the pads whose state changed since the previous one are
+    published (and, periodically, all the occupied ones). The input
+    path only increases a version number per change, and it only
+    ticks while somebody is watching, so the cost is bounded by the
+    rate and not by how many events the pads send.
+    """
+
+    def __init__(self, slots: PadSlots, timers: Timers, publish: Callable[[dict], Any],
+                 rate: float = STATE_RATE):
+        """
+        :param slots: The slots to watch.
+        :param timers: The timers to tick in.
+        :param publish: Publishes a single pad's state message.
+        :param rate: How many times per second the states are published.
+        """
+
+        self._slots = slots
+        self._timers = timers
+        self._publish = publish
+        self._interval = 1.0 / rate
+        self._versions: List[Optional[int]] = [None] * SLOTS_COUNT
+        self._next_keyframe = 0.0
+        self._lock = threading.Lock()
+        self._running = False
+        self._watched = False
+        # Each run of ticks has its own generation, so a tick that was
+        # already due when its run was stopped does not go on.
+        self._generation = 0
+        self._timer: Optional[Timer] = None
+        self._deadline = 0.0
+
+    def start(self):
+        """
+        Starts publishing. It only ticks while somebody is watching.
+        """
+
+        with self._lock:
+            self._running = True
+            self._update()
+
+    def stop(self):
+        """
+        Stops publishing.
+        """
+
+        with self._lock:
+            self._running = False
+            self._update()
+
+    def watch(self, watched: bool):
+        """
+        Tells whether somebody wants the messages. Ticking starts with
+        the first subscriber, and stops after the last one leaves.
+        :param watched: Whether somebody wants the messages.
+        """
+
+        with self._lock:
+            self._watched = watched
+            self._update()
+
+    def _update(self):
+        # Starts or stops the ticks, as needed. The lock must be held.
+        ticking = self._running and self._watched
+        if ticking and self._timer is None:
+            # Everything is published on the first tick.
+            self._versions = [None] * len(self._versions)
+            self._next_keyframe = 0.0
+            self._deadline = time.monotonic() + self._interval
+            self._timer = self._timers.schedule_at(self._deadline, self._tick, self._generation)
+        elif not ticking and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._generation += 1
+
+    def _tick(self, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+            # Keep the pace regardless of how long the ticks take.
+            now = time.monotonic()
+            self._deadline = max(self._deadline + self._interval, now)
+            self._timer = self._timers.schedule_at(self._deadline, self._tick, generation)
+
+        keyframe = now >= self._next_keyframe
+        if keyframe:
+            self._next_keyframe = now + _KEYFRAME_INTERVAL
+        for index in range(SLOTS_COUNT):
+            pad = self._slots[index]
+            version, state = pad.state
+            if version == self._versions[index] and not (keyframe and pad.status == PadSlot.Status.OCCUPIED):
+                continue
+            self._versions[index] = version
+            self._publish({"type": "notification", "code": "pad:state", "index": index, "state": state.hex()})
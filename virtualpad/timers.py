@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+
+LOGGER = logging.getLogger("hawa.virtualpad.timers")
+LOGGER.setLevel(logging.INFO)
+
+
+class Timer:
+    """
+    A scheduled callback. It can be cancelled before it is due.
+    """
+
+    def __init__(self, deadline: float, callback: Callable, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timers:
+    """
+    A single thread that runs all the scheduled callbacks (e.g. ping
+    deadlines and slot expirations) by a monotonic clock. The pending
+    timers are kept in a heap, and the thread only wakes up when the
+    earliest of them is due (or when an earlier one is scheduled).
+    Callbacks run in that thread, so they must be short.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """
+        Starts the timers thread.
+        """
+
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="virtualpad-timers")
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the timers thread. Pending timers are discarded.
+        """
+
+        with self._condition:
+            self._running = False
+            self._heap.clear()
+            self._condition.notify()
+
+    def schedule_at(self, deadline: float, callback: Callable, *args) -> Timer:
+        """
+        Schedules a callback at a given time.
+        :param deadline: The time, as given by time.monotonic().
+        :param callback: The callback.
+        :param args: The arguments for the callback.
+        :return: The timer, which can be cancelled.
+        """
+
+        timer = Timer(deadline, callback, args)
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), timer))
+            # Only wake the thread up if this is the new earliest timer.
+            if self._heap[0][2] is timer:
+                self._condition.notify()
+        return timer
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """
+        Schedules a callback after some time.
+        :param delay: The delay, in seconds.
+        :param callback: The callback.
+        :param args: The arguments for the callback.
+        :return: The timer, which can be cancelled.
+        """
+
+        return self.schedule_at(time.monotonic() + delay, callback, *args)
+
+    def _next(self) -> Optional[Timer]:
+        with self._condition:
+            while self._running:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                deadline, _, timer = self._heap[0]
+                if timer.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+                return timer
+        return None
+
+    def _run(self):
+        while True:
+            timer = self._next()
+            if timer is None:
+                return
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                LOGGER.exception("An error occurred in a timer callback!")
@@ -0,0 +1,148 @@
+import threading
+import time
+from typing import Optional, List, Dict
+from .pads.constants import SLOTS_COUNT
+
+
+# Every how many received batches one is traced (0 disables tracing).
+# Untraced batches cost a single check.
+_SAMPLE_EVERY = 0
+_countdown = 0
+# Latencies are counted in power-of-two buckets of microseconds,
+# up to ~1s (the last bucket takes anything above).
+_BUCKETS = 21
+
+
+def configure(sample_every: int):
+    """
+    Configures the latency tracing.
+    :param sample_every: Every how many received batches one is
+        traced. 1 traces all of them, and 0 disables tracing.
+    """
+
+    global _SAMPLE_EVERY, _countdown
+    _SAMPLE_EVERY = max(0, sample_every)
+    _countdown = _SAMPLE_EVERY
+
+
+def sample() -> Optional[int]:
+    """
+    Tells whether the batch just received is traced. Invoke this once
+    per batch, right after receiving it.
+    :return: The receive timestamp (from time.perf_counter_ns), or
+        None if this batch is not traced.
+    """
+
+    global _countdown
+    if not _SAMPLE_EVERY:
+        return None
+    _countdown -= 1
+    if _countdown > 0:
+        return None
+    _countdown = _SAMPLE_EVERY
+    return time.perf_counter_ns()
+
+
+class _LatencyHistogram:
+    """
+    A histogram of latencies in power-of-two microsecond buckets.
+    Percentiles are estimated as the upper bound of their bucket.
+    """
+
+    def __init__(self):
+        self._counts = [0] * _BUCKETS
+        self._count = 0
+        self._max = 0
+
+    def observe(self, nanoseconds: int):
+        micros = nanoseconds // 1000
+        self._counts[min(micros.bit_length(), _BUCKETS - 1)] += 1
+        self._count += 1
+        if nanoseconds > self._max:
+            self._max = nanoseconds
+
+    def _percentile(self, fraction: float) -> Optional[float]:
+        if not self._count:
+            return None
+        threshold = fraction * self._count
+        accumulated = 0
+        for bucket, count in enumerate(self._counts):
+            accumulated += count
+            if accumulated >= threshold:
+                # Bucket n holds the latencies below 2^n microseconds.
+                return min((1 << bucket) / 1e6, self._max / 1e9)
+        return self._max / 1e9
+
+    def serialize(self) -> dict:
+        """
+        Returns the p50, p99, and max latencies, in seconds.
+        """
+
+        return {
+            "p50": self._percentile(0.50),
+            "p99": self._percentile(0.99),
+            "max": self._max / 1e9 if self._count else None,
+        }
+
+
+class _PadLatencies:
+    """
+    The latencies of a single pad: from receiving a frame until it
+    is parsed, from then until its events are written to the device
+    (after the SYN), and the whole of it.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.parse = _LatencyHistogram()
+        self.emit = _LatencyHistogram()
+        self.total = _LatencyHistogram()
+
+    def serialize(self) -> dict:
+        return {
+            "count": self.count,
+            "parse": self.parse.serialize(),
+            "emit": self.emit.serialize(),
+            "total": self.total.serialize(),
+        }
+
+
+_LOCK = threading.Lock()
+_PADS: List[_PadLatencies] = [_PadLatencies() for _ in range(SLOTS_COUNT)]
+
+
+def record(pad_index: int, received: int, parsed: int, emitted: int):
+    """
+    Records the latencies of a traced frame.
+    :param pad_index: The pad the frame was received for.
+    :param received: When the frame was received.
+    :param parsed: When the frame was parsed.
+    :param emitted: When the frame's events were written to the device.
+    """
+
+    with _LOCK:
+        latencies = _PADS[pad_index]
+        latencies.count += 1
+        latencies.parse.observe(parsed - received)
+        latencies.emit.observe(emitted - parsed)
+        latencies.total.observe(emitted - received)
+
+
+def report() -> Dict[str, object]:
+    """
+    Gets the latencies of all the pads.
+    :return: The sampling setting, and the latencies per pad.
+    """
+
+    with _LOCK:
+        return {"sample_every": _SAMPLE_EVERY, "pads": [latencies.serialize() for latencies in _PADS]}
+
+
+def reset():
+    """
+    Clears all the recorded latencies.
+    """
+
+    global _PADS
+    with _LOCK:
+        _PADS = [_PadLatencies() for _ in range(SLOTS_COUNT)]
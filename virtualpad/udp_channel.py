@@ -0,0 +1,171 @@
+import functools
+import logging
+import secrets
+import socket
+import struct
+import threading
+from typing import Any, Callable, Dict
+from .metrics import BYTES, UDP_DROPPED
+
+
+LOGGER = logging.getLogger("hawa.virtualpad.udp-channel")
+LOGGER.setLevel(logging.INFO)
+UDP_PORT = 2359
+# Each datagram starts with the session token given over TCP and a
+# sequence number, and then it has a single frame (a length byte and
+# its (key, state) pairs).
+HEADER = struct.Struct("!QI")
+# Sequence numbers wrap around: a datagram is newer than the last one
+# when it is less than half the sequence space ahead of it.
+_SEQ_MASK = 0xFFFFFFFF
+_SEQ_HALF = 1 << 31
+_DATAGRAM_SIZE = 2048
+
+# The sinks get the frame of each datagram, and tell whether it was valid.
+Sink = Callable[[memoryview], bool]
+Dispatch = Callable[[Callable[[memoryview], Any], memoryview], Any]
+
+
+def _call(receive: Callable[[memoryview], Any], frame: memoryview):
+    receive(frame)
+
+
+class _Peer:
+    """
+    A pad session that receives input via UDP, and the sequence
+    number of the last datagram accepted for it.
+    """
+
+    def __init__(self, sink: Sink):
+        self.sink = sink
+        self.last_seq = None
+
+    def receive(self, seq: int, frame: memoryview):
+        """
+        Gives a frame to the sink, unless its datagram is older than
+        the last accepted one. The datagram is only accepted (and its
+        sequence number kept) when the frame is valid, so a malformed
+        one does not make the next valid ones look stale.
+        :param seq: The datagram's sequence number.
+        :param frame: The datagram's frame.
+        """
+
+        last_seq = self.last_seq
+        if last_seq is not None and not 0 < (seq - last_seq) & _SEQ_MASK < _SEQ_HALF:
+            UDP_DROPPED.inc("stale")
+            return
+        if self.sink(frame):
+            self.last_seq = seq
+
+
+class UdpChannel:
+    """
+    An optional input channel for the pads, alongside the TCP server.
+    A lost datagram does not stall the ones after it (as a lost TCP
+    segment does), so it is better suited for lossy networks. Pads
+    authenticate over TCP first and get a session token there, which
+    they send in each datagram. Datagrams older than the last accepted
+    one (by their sequence number) are dropped, and lost ones are not
+    recovered: pads are expected to send their whole state often.
+    """
+
+    def __init__(self, port: int = UDP_PORT, dispatch: Dispatch = _call):
+        """
+        :param port: The port to bind.
+        :param dispatch: Runs a peer's receiving function with a frame,
+            where the pads' input is processed. By default, it is done in
+            the channel's thread. Frames are only valid during the call,
+            so a dispatch that defers the function must copy them.
+        """
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(("0.0.0.0", port))
+        self._port = self._socket.getsockname()[1]
+        self._dispatch = dispatch
+        self._peers: Dict[int, _Peer] = {}
+        self._lock = threading.Lock()
+        self._buffer = bytearray(_DATAGRAM_SIZE)
+        self._thread = None
+        self._running = False
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    def open(self, sink: Sink) -> int:
+        """
+        Opens a session.
+        :param sink: Processes the session's frames.
+        :return: The session token.
+        """
+
+        with self._lock:
+            token = 0
+            while not token or token in self._peers:
+                token = secrets.randbits(64)
+            self._peers[token] = _Peer(sink)
+        return token
+
+    def close(self, token: int):
+        """
+        Closes a session. Its datagrams are dropped from now on.
+        :param token: The session token.
+        """
+
+        with self._lock:
+            self._peers.pop(token, None)
+
+    def start(self):
+        """
+        Starts receiving datagrams, in a separate thread.
+        """
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="virtualpad-udp")
+        self._thread.start()
+        LOGGER.info(f"Receiving pad input via UDP on port {self._port}")
+
+    def stop(self):
+        """
+        Stops receiving datagrams, and closes the socket.
+        """
+
+        if self._running:
+            self._running = False
+            # Wake the thread up.
+            try:
+                self._socket.sendto(b"", ("127.0.0.1", self._port))
+            except OSError:
+                pass
+            self._thread.join()
+        self._socket.close()
+
+    def _run(self):
+        view = memoryview(self._buffer)
+        while self._running:
+            try:
+                count, _ = self._socket.recvfrom_into(self._buffer)
+            except OSError:
+                return
+            if not self._running:
+                return
+            BYTES.inc("udp", "in", amount=count)
+            try:
+                self._receive(view[:count])
+            except Exception:
+                LOGGER.exception("An error occurred while processing a datagram")
+
+    def _receive(self, datagram: memoryview):
+        if len(datagram) <= HEADER.size:
+            UDP_DROPPED.inc("malformed")
+            return
+
+        token, seq = HEADER.unpack_from(datagram)
+        peer = self._peers.get(token)
+        if peer is None:
+            UDP_DROPPED.inc("unknown")
+            return
+
+        # The sequence number is checked where the frame is processed,
+        # so it is only kept once the frame turned out to be valid.
+        self._dispatch(functools.partial(peer.receive, seq), datagram[HEADER.size:])